@@ -0,0 +1,19 @@
+#!/usr/bin/python3
+"""
+Upgrades an existing database to the current models.
+
+Adds the indexes and constraints declared in 'models/tables.py' that are
+missing from a database created by an older version of the application.
+The script is safe to run several times.
+"""
+
+
+def migrate():
+    """Adds the missing indexes and constraints to the database."""
+    from models import storage
+    storage.migrate()
+    storage.close()
+
+
+if __name__ == '__main__':
+    migrate()
@@ -1,15 +1,32 @@
 #!/usr/bin/python3
 """Module handling database storage and interaction"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain
+from models.reference import Reference
 from models.tables import *
 from os import getenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import (create_engine, event, func, insert, inspect, select,
+                        text, tuple_, update)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from threading import Lock
+
+# Small, rarely changing tables cached in-process by DBStorage.reference()
+REFERENCE_CLASSES = (Dose, Hospital, Vaccine)
+# Columns left out of the cache, because they change too often and are read
+# from elsewhere (the stock balances come from get_stock())
+UNCACHED_COLUMNS = {Vaccine: ('stock',)}
 
 
 class DBStorage:
     """Class managing database storage and interaction"""
     __engine = None
     __session = None
+    __references = None
+    __reference_version = None
+    __reference_lock = None
 
     def __init__(self):
         """
@@ -47,6 +64,110 @@ class DBStorage:
             dictionary[key] = obj
         return dictionary
 
+    def query(self, cls, *criteria, order_by=None, limit=None, offset=None,
+              after=None, columns=None, group_by=None, options=None,
+              **filters):
+        """
+        Get objects matching filters, sorted and paginated by the database.
+
+        Args:
+        - cls: The class of objects to retrieve.
+        - criteria: Optional SQLAlchemy filter expressions,
+          e.g. Dose.term <= 30.
+        - order_by: A column or a list of columns to sort on,
+          e.g. Dose.denomination or [Nurse.first_name, Nurse.id].
+        - limit: Maximum number of results.
+        - offset: Number of results to skip.
+        - after: Keyset cursor, the order_by value(s) of the last row of the
+          previous page. Only rows sorted after it are returned, which
+          avoids scanning skipped rows like offset does.
+        - columns: Optional list of columns, or of column names, to select
+          instead of whole objects, e.g. [Dose.denomination, Dose.term] or
+          ['denomination', 'term']. The rows are compact, immutable
+          tuples, not tracked by the session, which makes them cheaper
+          than objects for read-only listings.
+        - group_by: Optional column or list of columns to group the rows
+          on, used with aggregate columns, e.g. Nurse.hospital_id with
+          [Nurse.hospital_id, func.count()].
+        - options: Optional list of loader options used to load
+          relationships with set-based queries instead of one lazy load per
+          object, e.g. [selectinload(Child.doses)].
+        - filters: Optional column equality filters,
+          e.g. hospital_id=hospital.id.
+
+        Returns:
+        - A list of objects, or of rows when columns are given.
+        """
+        if order_by is not None and not isinstance(order_by, (list, tuple)):
+            order_by = [order_by]
+        if columns:
+            columns = [getattr(cls, column) if isinstance(column, str)
+                       else column for column in columns]
+            query = self.__session.query(*columns).select_from(cls)
+        else:
+            query = self.__session.query(cls)
+        if options:
+            query = query.options(*options)
+        if criteria:
+            query = query.filter(*criteria)
+        if filters:
+            query = query.filter_by(**filters)
+        if after is not None:
+            if not order_by:
+                raise ValueError('A keyset cursor requires order_by')
+            if not isinstance(after, (list, tuple)):
+                after = [after]
+            query = query.filter(tuple_(*order_by) > tuple_(*after))
+        if group_by is not None:
+            if not isinstance(group_by, (list, tuple)):
+                group_by = [group_by]
+            query = query.group_by(*group_by)
+        if order_by:
+            query = query.order_by(*order_by)
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    def iter(self, cls, *criteria, batch_size=1000, columns=None,
+             **filters):
+        """
+        Iterate over the objects of a table in bounded memory.
+
+        The rows are streamed with a server-side cursor and hydrated
+        'batch_size' at a time (yield_per), so a job can go through millions
+        of rows in constant memory. The stream runs on its own connection and
+        read-only session: the loop body may use the storage freely, but
+        changes made to the yielded objects are not saved.
+
+        Args:
+        - cls: The class of objects to iterate over.
+        - criteria: Optional SQLAlchemy filter expressions,
+          e.g. Child.birthdate > date.
+        - batch_size: Number of rows fetched at once.
+        - columns: Optional list of columns to select instead of whole
+          objects, e.g. [Child.id, Child.birthdate].
+        - filters: Optional column equality filters,
+          e.g. parent_id=user.id.
+
+        Yields:
+        - The objects, or rows when columns are given.
+        """
+        session = Session(bind=self.__engine)
+        try:
+            if columns:
+                query = session.query(*columns).select_from(cls)
+            else:
+                query = session.query(cls)
+            if criteria:
+                query = query.filter(*criteria)
+            if filters:
+                query = query.filter_by(**filters)
+            yield from query.yield_per(batch_size)
+        finally:
+            session.close()
+
     def new(self, obj):
         """
         Add a new object to the session.
@@ -57,8 +178,556 @@ class DBStorage:
         self.__session.add(obj)
 
     def save(self):
-        """Commit changes made to the session to the database"""
-        self.__session.commit()
+        """
+        Commit changes made to the session to the database.
+
+        Inside a unit of work started by begin(), the changes are only
+        flushed; they are committed once by commit().
+        """
+        if self.__session.info.get('unit_of_work'):
+            self.__session.flush()
+            self.__session.info['pending'] = True
+        else:
+            self.__session.commit()
+
+    def begin(self):
+        """
+        Start a unit of work on the current session.
+
+        Until commit() is called, save() flushes changes instead of committing
+        them, so all the changes of a request are committed atomically with a
+        single commit.
+        """
+        self.__session.info['unit_of_work'] = True
+        self.__session.info['pending'] = False
+
+    def commit(self):
+        """
+        Commit the unit of work started by begin().
+
+        Nothing is sent to the database when the unit of work holds no change.
+        """
+        session = self.__session
+        pending = session.info.pop('pending', False)
+        session.info.pop('unit_of_work', None)
+        callbacks = session.info.pop('after_commit', [])
+        if pending or session.new or session.dirty or session.deleted:
+            session.commit()
+        for callback in callbacks:
+            callback()
+
+    def after_commit(self, callback):
+        """
+        Run a callback once the unit of work is committed.
+
+        Side effects that must not happen for changes that are rolled back,
+        e.g. sending an email holding a token, are deferred until commit().
+        They are discarded by rollback() and close(). Outside a unit of work,
+        the callback runs at once.
+
+        Args:
+        - callback: The function to call, without arguments.
+        """
+        if self.__session.info.get('unit_of_work'):
+            self.__session.info.setdefault('after_commit', []).append(callback)
+        else:
+            callback()
+
+    def rollback(self):
+        """Discard the changes of the current transaction or unit of work"""
+        self.__session.info.pop('pending', None)
+        self.__session.info.pop('after_commit', None)
+        self.__session.info.pop('unit_of_work', None)
+        self.__session.rollback()
+
+    @contextmanager
+    def nested(self):
+        """
+        Run a block of changes inside a nested transaction (SAVEPOINT).
+
+        The changes made in the block are rolled back on their own if the block
+        raises, without discarding the rest of the unit of work.
+        """
+        with self.__session.begin_nested():
+            yield self
+
+    def adjust(self, cls, column, delta, **filters):
+        """
+        Atomically add a delta to a numeric column.
+
+        The increment is computed by the database with a single
+        UPDATE ... SET column = column + delta statement, so concurrent
+        requests can not lose each other's updates. The filters are expected
+        to match a single row, e.g. id=vaccine.id.
+
+        Args:
+        - cls: The class of the object to update.
+        - column: The name of the column to adjust, e.g. 'stock'.
+        - delta: The quantity to add, negative to subtract.
+        - filters: Column equality filters selecting the row.
+
+        Returns:
+        - The new value of the column, or None if no row matched.
+        """
+        table = cls.__table__
+        target = table.c[column]
+        conditions = [table.c[key] == item for key, item in filters.items()]
+        statement = update(table).where(*conditions)
+        new_value = func.coalesce(target, 0) + delta
+        dialect = self.__engine.dialect
+        if dialect.update_returning:
+            result = self.__session.execute(
+                statement.values({target: new_value}).returning(target))
+            value = result.scalar()
+        elif dialect.name == 'mysql':
+            # LAST_INSERT_ID(expr) hands the new value back with the UPDATE
+            # response, which saves reading the row again.
+            result = self.__session.execute(
+                statement.values({target: func.last_insert_id(new_value)}))
+            value = result.lastrowid if result.rowcount else None
+            if value is not None and value >= 2 ** 63:
+                value -= 2 ** 64
+        else:
+            result = self.__session.execute(
+                statement.values({target: new_value}))
+            value = None
+            if result.rowcount:
+                value = self.__session.execute(
+                    select(target).where(*conditions)).scalar()
+        if value is not None:
+            self.__session.info['pending'] = True
+            if cls in REFERENCE_CLASSES and \
+                    column not in UNCACHED_COLUMNS.get(cls, ()):
+                self.__bump_reference_version(self.__session)
+            # Keep the objects already loaded in the session up to date
+            for obj in list(self.__session.identity_map.values()):
+                if isinstance(obj, cls) and all(
+                        getattr(obj, key) == item
+                        for key, item in filters.items()):
+                    set_committed_value(obj, column, value)
+        return value
+
+    def get_stock(self, hospital_id=None, vaccine_id=None):
+        """
+        Get the current stock balances of vaccines.
+
+        A balance is the counter rolled up by the last compaction
+        (Vaccine.stock, or Hospital_Vaccine.quantity for a hospital) plus the
+        stock movements appended since then.
+
+        Args:
+        - hospital_id: Optional hospital ID. If None, returns the overall
+          stock of each vaccine.
+        - vaccine_id: Optional vaccine ID to restrict the result to.
+
+        Returns:
+        - A dictionary of stock balances keyed by vaccine ID.
+        """
+        session = self.__session
+        tail = session.query(Stock_Movement.vaccine_id,
+                             func.sum(Stock_Movement.delta)) \
+            .filter_by(compacted=False)
+        if hospital_id is None:
+            key = Vaccine.id
+            counters = session.query(key, Vaccine.stock)
+        else:
+            key = Hospital_Vaccine.vaccine_id
+            counters = session.query(key, Hospital_Vaccine.quantity) \
+                .filter(Hospital_Vaccine.hospital_id == hospital_id)
+            tail = tail.filter_by(hospital_id=hospital_id)
+        if vaccine_id is not None:
+            counters = counters.filter(key == vaccine_id)
+            tail = tail.filter_by(vaccine_id=vaccine_id)
+        balances = {id: quantity or 0 for id, quantity in counters}
+        for id, delta in tail.group_by(Stock_Movement.vaccine_id):
+            if id in balances:
+                balances[id] += int(delta)
+        return balances
+
+    def compact_stock(self, batch_size=10000):
+        """
+        Roll the stock movements not yet compacted into the stock counters.
+
+        Claims a batch of movements, adds their sum to Vaccine.stock and to the
+        matching Hospital_Vaccine.quantity, and flags them as compacted in the
+        same transaction. Movements are kept as the stock history.
+
+        Args:
+        - batch_size: Maximum number of movements compacted by one call.
+
+        Returns:
+        - The number of movements compacted.
+        """
+        session = self.__session
+        movements = session.query(Stock_Movement.id,
+                                  Stock_Movement.hospital_id,
+                                  Stock_Movement.vaccine_id,
+                                  Stock_Movement.delta) \
+            .filter_by(compacted=False) \
+            .order_by(Stock_Movement.id) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True).all()
+        if not movements:
+            return 0
+        vaccines = {}
+        hospital_vaccines = {}
+        for movement in movements:
+            vaccines[movement.vaccine_id] = \
+                vaccines.get(movement.vaccine_id, 0) + movement.delta
+            if movement.hospital_id:
+                key = (movement.hospital_id, movement.vaccine_id)
+                hospital_vaccines[key] = \
+                    hospital_vaccines.get(key, 0) + movement.delta
+        for vaccine_id, delta in vaccines.items():
+            if delta:
+                self.adjust(Vaccine, 'stock', delta, id=vaccine_id)
+        for (hospital_id, vaccine_id), delta in hospital_vaccines.items():
+            if delta:
+                self.adjust(Hospital_Vaccine, 'quantity', delta,
+                            hospital_id=hospital_id, vaccine_id=vaccine_id)
+        session.query(Stock_Movement) \
+            .filter(Stock_Movement.id.in_([movement.id
+                                           for movement in movements])) \
+            .update({'compacted': True}, synchronize_session=False)
+        self.save()
+        return len(movements)
+
+    def add_emails(self, emails):
+        """
+        Add emails to the outbox with a single bulk insert.
+
+        Emails whose idempotency key is already in the outbox are skipped, so
+        producers can safely run again after a failure.
+
+        Args:
+        - emails: An iterable of dictionaries with the 'recipient',
+          'template', 'payload' and 'idempotency_key' of each email.
+        """
+        now = datetime.now()
+        rows = [dict(email, status='pending', attempts=0,
+                     next_attempt_at=now, created_at=now) for email in emails]
+        if not rows:
+            return
+        statement = insert(Email_Outbox.__table__) \
+            .prefix_with('IGNORE', dialect='mysql') \
+            .prefix_with('OR IGNORE', dialect='sqlite')
+        self.__session.execute(statement, rows)
+        self.__session.info['pending'] = True
+
+    def claim_emails(self, batch_size=100, lease=300):
+        """
+        Claim a batch of emails due for delivery.
+
+        Due rows are locked with SELECT ... FOR UPDATE SKIP LOCKED, so
+        concurrent workers claim different rows, then leased to the caller
+        for 'lease' seconds and committed. Rows of a worker that died while
+        sending become due again when their lease expires.
+
+        Args:
+        - batch_size: Maximum number of emails claimed.
+        - lease: Number of seconds the caller has to deliver the emails.
+
+        Returns:
+        - The list of claimed Email_Outbox objects.
+        """
+        now = datetime.now()
+        emails = self.__session.query(Email_Outbox) \
+            .filter(Email_Outbox.status.in_(('pending', 'sending')),
+                    Email_Outbox.next_attempt_at <= now) \
+            .order_by(Email_Outbox.next_attempt_at) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True).all()
+        for email in emails:
+            email.status = 'sending'
+            email.attempts += 1
+            email.next_attempt_at = now + timedelta(seconds=lease)
+        self.save()
+        return emails
+
+    def extend_email_leases(self, ids, lease=300):
+        """
+        Extend the lease of emails still being delivered.
+
+        Keeps another worker from claiming emails again while a slow or
+        rate limited delivery is still sending them.
+
+        Args:
+        - ids: The IDs of the claimed emails.
+        - lease: Number of seconds from now the caller has to deliver them.
+        """
+        if not ids:
+            return
+        self.__session.query(Email_Outbox) \
+            .filter(Email_Outbox.id.in_(ids),
+                    Email_Outbox.status == 'sending') \
+            .update({'next_attempt_at': datetime.now() +
+                     timedelta(seconds=lease)}, synchronize_session=False)
+        self.save()
+
+    def next_email_attempt(self):
+        """
+        Get the time the next email of the outbox is due for delivery.
+
+        Returns:
+        - The earliest next_attempt_at of the emails waiting for delivery,
+          or None if the outbox is empty.
+        """
+        return self.__session.query(func.min(Email_Outbox.next_attempt_at)) \
+            .filter(Email_Outbox.status.in_(('pending', 'sending'))) \
+            .scalar()
+
+    def claim_leases(self, job, owner, count, lease=90):
+        """
+        Claim a fair share of the partitions of a job for a worker.
+
+        Every call is a heartbeat: it extends the presence of the worker and
+        the leases it holds. The partitions are shared evenly between the
+        live workers; a worker above its share releases the extra ones, and
+        one below it takes over free partitions and those whose lease
+        expired, e.g. because their worker died. Each takeover is a
+        conditional UPDATE, so a partition is never held by two workers.
+
+        Args:
+        - job: The name of the job.
+        - owner: A name unique to the worker, e.g. its host and process ID.
+        - count: The number of partitions of the job.
+        - lease: Number of seconds the leases last without a heartbeat.
+
+        Returns:
+        - The sorted list of the partitions held by the worker.
+        """
+        session = self.__session
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=lease)
+        workers = Job_Worker.__table__
+        leases = Job_Lease.__table__
+        session.execute(workers.delete().where(workers.c.job == job,
+                                               workers.c.expires_at <= now))
+        if not session.execute(update(workers)
+                               .where(workers.c.job == job,
+                                      workers.c.owner == owner)
+                               .values(expires_at=expires_at)).rowcount:
+            session.execute(insert(workers).values(job=job, owner=owner,
+                                                   expires_at=expires_at))
+        rows = session.execute(select(leases.c.shard, leases.c.owner,
+                                      leases.c.expires_at)
+                               .where(leases.c.job == job)).all()
+        missing = set(range(count)) - {row.shard for row in rows}
+        if missing:
+            session.execute(insert(leases)
+                            .prefix_with('IGNORE', dialect='mysql')
+                            .prefix_with('OR IGNORE', dialect='sqlite'),
+                            [{'job': job, 'shard': shard, 'owner': None,
+                              'expires_at': now} for shard in missing])
+        live = session.execute(select(func.count()).select_from(workers)
+                               .where(workers.c.job == job,
+                                      workers.c.expires_at > now)).scalar()
+        share = -(-count // max(live, 1))
+        session.execute(update(leases)
+                        .where(leases.c.job == job, leases.c.owner == owner)
+                        .values(expires_at=expires_at))
+        held = sorted(row.shard for row in rows if row.owner == owner)
+        if len(held) > share:
+            session.execute(update(leases)
+                            .where(leases.c.job == job,
+                                   leases.c.owner == owner,
+                                   leases.c.shard.in_(held[share:]))
+                            .values(owner=None, expires_at=now))
+            held = held[:share]
+        free = sorted(missing | {row.shard for row in rows
+                                 if row.owner is None or
+                                 row.expires_at <= now})
+        for shard in free:
+            if len(held) >= share:
+                break
+            if session.execute(update(leases)
+                               .where(leases.c.job == job,
+                                      leases.c.shard == shard,
+                                      (leases.c.owner.is_(None)) |
+                                      (leases.c.expires_at <= now))
+                               .values(owner=owner,
+                                       expires_at=expires_at)).rowcount:
+                held.append(shard)
+        self.save()
+        return sorted(held)
+
+    def release_leases(self, job, owner):
+        """
+        Release the partitions of a job held by a worker.
+
+        Called when a worker stops, so the other workers take its partitions
+        over without waiting for the leases to expire.
+
+        Args:
+        - job: The name of the job.
+        - owner: The name of the worker.
+        """
+        workers = Job_Worker.__table__
+        leases = Job_Lease.__table__
+        self.__session.execute(update(leases)
+                               .where(leases.c.job == job,
+                                      leases.c.owner == owner)
+                               .values(owner=None,
+                                       expires_at=datetime.now()))
+        self.__session.execute(workers.delete().where(
+            workers.c.job == job, workers.c.owner == owner))
+        self.save()
+
+    def get_watermark(self, name):
+        """
+        Get the point up to which a periodic job has run.
+
+        Args:
+        - name: The name of the job.
+
+        Returns:
+        - The watermark date of the job, or None if it never ran.
+        """
+        return self.__session.query(Job_Watermark.watermark) \
+            .filter_by(name=name).scalar()
+
+    def set_watermark(self, name, watermark):
+        """
+        Record the point up to which a periodic job has run.
+
+        The watermark is saved with the changes of the job, so it only moves
+        forward if they are committed.
+
+        Args:
+        - name: The name of the job.
+        - watermark: The new watermark date.
+        """
+        job = self.__session.get(Job_Watermark, name)
+        if job is None:
+            self.__session.add(Job_Watermark(name=name, watermark=watermark))
+        else:
+            job.watermark = watermark
+
+    def get_snapshot(self, name):
+        """
+        Get a precomputed snapshot, e.g. of dashboard statistics.
+
+        Args:
+        - name: The name of the snapshot.
+
+        Returns:
+        - A row with the serialized 'data' of the snapshot and the time it
+          was 'refreshed_at', or None if it was never computed.
+        """
+        return self.__session.query(Dashboard_Snapshot.data,
+                                    Dashboard_Snapshot.refreshed_at) \
+            .filter_by(name=name).first()
+
+    def set_snapshot(self, name, data):
+        """
+        Store a precomputed snapshot, replacing the previous one.
+
+        Args:
+        - name: The name of the snapshot.
+        - data: The serialized data of the snapshot.
+        """
+        snapshot = self.__session.get(Dashboard_Snapshot, name)
+        if snapshot is None:
+            snapshot = Dashboard_Snapshot(name=name)
+            self.__session.add(snapshot)
+        snapshot.data = data
+        snapshot.refreshed_at = datetime.now()
+
+    def schedule_child(self, child):
+        """
+        Fill or refresh the due dates of the doses of a child.
+
+        Must be called when a child is added or its birthdate changes, so
+        the due dates are looked up with range scans on the schedule instead
+        of being computed from the age of every child. A dose already
+        reminded is reminded again when its due date moves, unless it was
+        administered.
+
+        Args:
+        - child: The Child object, new or already stored.
+        """
+        scheduled = {row.dose_id: row for row in child.schedule}
+        for dose in self.reference(Dose).rows:
+            if dose.term is None:
+                continue
+            due_date = Child_Dose_Schedule.due_date_of(child.birthdate,
+                                                       dose.term)
+            if dose.id in scheduled:
+                row = scheduled[dose.id]
+                if row.due_date != due_date:
+                    row.due_date = due_date
+                    # The reminder sent was for the former due date
+                    if row.status == 'notified':
+                        row.status = 'pending'
+            else:
+                child.schedule.append(Child_Dose_Schedule(
+                    dose_id=dose.id, due_date=due_date, status='pending',
+                    shard=Child_Dose_Schedule.shard_of(child.parent_id)))
+
+    def get_due_doses(self, start, end, limit=None, shard=None,
+                      parent_id=None):
+        """
+        Get the doses falling due for children, with a single query.
+
+        The pending rows of the schedule are read with a range scan on their
+        due date, joined with the child, the dose and the parent.
+
+        Args:
+        - start: First due date of the window.
+        - end: End of the due window, excluded.
+        - limit: Optional maximum number of rows.
+        - shard: Optional partition of the reminder job to restrict the
+          result to.
+        - parent_id: Optional ID of the parent to restrict the result to.
+
+        Returns:
+        - A list of rows with the child_id, child_name, dose_id,
+          denomination, due_date, parent_id, parent_name and email of each
+          due dose, grouped by parent.
+        """
+        schedule = Child_Dose_Schedule
+        query = self.__session.query(
+            schedule.child_id, Child.first_name.label('child_name'),
+            schedule.dose_id, Dose.denomination, schedule.due_date,
+            Child.parent_id, User.first_name.label('parent_name'),
+            User.email) \
+            .select_from(schedule) \
+            .join(Child, Child.id == schedule.child_id) \
+            .join(Dose, Dose.id == schedule.dose_id) \
+            .join(User, User.id == Child.parent_id) \
+            .filter(schedule.status == 'pending',
+                    schedule.due_date >= start, schedule.due_date < end) \
+            .order_by(Child.parent_id, schedule.due_date, schedule.child_id,
+                      schedule.dose_id)
+        if shard is not None:
+            query = query.filter(schedule.shard == shard)
+        if parent_id is not None:
+            query = query.filter(Child.parent_id == parent_id)
+        return query.limit(limit).all()
+
+    def add_notifications(self, pairs):
+        """
+        Record doses as notified with bulk statements.
+
+        Args:
+        - pairs: An iterable of (child_id, dose_id) tuples. Pairs already
+          recorded are skipped.
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return
+        statement = insert(child_dose_notifications) \
+            .prefix_with('IGNORE', dialect='mysql') \
+            .prefix_with('OR IGNORE', dialect='sqlite')
+        self.__session.execute(statement, [
+            {'child_id': child_id, 'dose_id': dose_id}
+            for child_id, dose_id in pairs])
+        schedule = Child_Dose_Schedule
+        self.__session.query(schedule) \
+            .filter(tuple_(schedule.child_id, schedule.dose_id).in_(pairs),
+                    schedule.status == 'pending') \
+            .update({'status': 'notified'}, synchronize_session=False)
+        self.__session.info['pending'] = True
 
     def delete(self, obj=None):
         """
@@ -83,14 +752,271 @@ class DBStorage:
         - Initializes a session factory and sets up a scoped session for database interaction.
         """
         Base.metadata.create_all(self.__engine)
+        try:
+            with self.__engine.begin() as connection:
+                version = connection.execute(
+                    select(Cache_Version.version)
+                    .where(Cache_Version.name == 'reference')).first()
+                if version is None:
+                    connection.execute(Cache_Version.__table__.insert()
+                                       .values(name='reference', version=0))
+        except IntegrityError:
+            # Another worker created the row at the same time
+            pass
         sess_factory = sessionmaker(bind=self.__engine, expire_on_commit=False)
+        event.listen(sess_factory, 'before_flush',
+                     self.__track_reference_changes)
+        event.listen(sess_factory, 'after_commit', self.__end_transaction)
+        event.listen(sess_factory, 'after_rollback', self.__end_transaction)
         Session = scoped_session(sess_factory)
         self.__session = Session
+        self.__references = {}
+        self.__reference_version = None
+        self.__reference_lock = Lock()
+
+    def reference(self, cls):
+        """
+        Get the cached snapshot of a reference table (Dose, Hospital or Vaccine).
+
+        The snapshot is shared by all the requests of the worker. Its version is
+        checked against the database once per transaction, so changes committed
+        by any worker are picked up by the next request.
+
+        Args:
+        - cls: The class of the reference table.
+
+        Returns:
+        - A Reference snapshot holding the rows and their indexes.
+        """
+        session = self.__session
+        uncached = UNCACHED_COLUMNS.get(cls, ())
+        columns = [column for column in cls.__table__.columns
+                   if column.name not in uncached]
+        if session.info.get('reference_changed'):
+            # Uncommitted changes must not leak into the shared snapshot
+            return Reference(session.query(*columns))
+        version = session.info.get('reference_version')
+        if version is None:
+            version = session.query(Cache_Version.version) \
+                .filter_by(name='reference').scalar() or 0
+            session.info['reference_version'] = version
+        with self.__reference_lock:
+            if version != self.__reference_version:
+                self.__references = {}
+                self.__reference_version = version
+            if cls not in self.__references:
+                self.__references[cls] = Reference(session.query(*columns))
+            return self.__references[cls]
+
+    def __bump_reference_version(self, session):
+        """Invalidates the reference data cached by every worker"""
+        if session.info.get('reference_changed'):
+            return
+        session.info['reference_changed'] = True
+        table = Cache_Version.__table__
+        session.execute(update(table)
+                        .where(table.c.name == 'reference')
+                        .values(version=table.c.version + 1))
+
+    def __track_reference_changes(self, session, flush_context, instances):
+        """Bumps the reference data version when a flush changes it"""
+        if any(isinstance(obj, REFERENCE_CLASSES)
+               for obj in chain(session.new, session.deleted)) or \
+                any(isinstance(obj, REFERENCE_CLASSES) and
+                    self.__changes_cached_columns(obj)
+                    for obj in session.dirty):
+            self.__bump_reference_version(session)
+
+    @staticmethod
+    def __changes_cached_columns(obj):
+        """
+        Tells whether a loaded reference object has changes to cached columns.
+
+        Objects only touched through a relationship, e.g. a Dose appended to
+        Child.doses, are marked dirty by the backref without any column
+        changing, so they must not invalidate the cache.
+        """
+        state = inspect(obj)
+        uncached = UNCACHED_COLUMNS.get(type(obj), ())
+        return any(state.attrs[attr.key].history.has_changes()
+                   for attr in state.mapper.column_attrs
+                   if attr.key not in uncached)
+
+    def __end_transaction(self, session):
+        """Drops the per-transaction reference data state"""
+        if session.info.pop('reference_changed', False):
+            self.__reference_version = None
+        session.info.pop('reference_version', None)
+
+    def migrate(self):
+        """
+        Adds the indexes and constraints declared in the models to an
+        existing database.
+
+        create_all() only creates missing tables, so databases created before
+        an index was declared never get it. This method compares the declared
+        indexes with the ones found in the database and creates the missing
+        ones, skipping those already covered by an index on the same columns
+        (e.g. the indexes MySQL creates for foreign keys).
+
+        Notes:
+        - Duplicated hospital_vaccine pairs are merged, summing their
+          quantities, before the unique index is created.
+        - Duplicated child_dose_notifications rows are removed before the
+          primary key is added.
+        - The shard column is added to schedules created before the
+          reminder job was partitioned, and the scheduled doses are moved to
+          the partition of the parent of their child.
+        - The doses missing from the schedule of the children are added, so
+          it must be run again after adding doses.
+        """
+        Base.metadata.create_all(self.__engine)
+        inspector = inspect(self.__engine)
+        with self.__engine.begin() as connection:
+            table = Child_Dose_Schedule.__table__
+            columns = [column['name']
+                       for column in inspector.get_columns(table.name)]
+            if 'shard' not in columns:
+                connection.execute(text(
+                    'ALTER TABLE child_dose_schedule '
+                    'ADD COLUMN shard INTEGER NOT NULL DEFAULT 0'))
+            self.__shard_schedule(connection)
+            table = child_dose_notifications
+            primary_key = inspector.get_pk_constraint(table.name)
+            if not primary_key.get('constrained_columns'):
+                self.__deduplicate_notifications(connection)
+                connection.execute(text(
+                    'ALTER TABLE child_dose_notifications '
+                    'ADD PRIMARY KEY (child_id, dose_id)'))
+            for table in Base.metadata.sorted_tables:
+                existing = inspector.get_indexes(table.name)
+                for index in table.indexes:
+                    columns = [column.name for column in index.columns]
+                    if any(item['name'] == index.name or
+                           (item['column_names'] == columns and
+                            (item['unique'] or not index.unique))
+                           for item in existing):
+                        continue
+                    if table.name == Hospital_Vaccine.__tablename__ and \
+                            index.unique:
+                        self.__merge_hospital_vaccines(connection)
+                    index.create(connection)
+            self.__schedule_children(connection)
+
+    def __deduplicate_notifications(self, connection):
+        """Keeps a single row per (child_id, dose_id) notification pair"""
+        table = child_dose_notifications
+        duplicates = connection.execute(
+            select(table.c.child_id, table.c.dose_id)
+            .group_by(table.c.child_id, table.c.dose_id)
+            .having(func.count() > 1)).all()
+        for child_id, dose_id in duplicates:
+            connection.execute(table.delete().where(
+                table.c.child_id == child_id, table.c.dose_id == dose_id))
+            connection.execute(table.insert().values(child_id=child_id,
+                                                     dose_id=dose_id))
+
+    def __schedule_children(self, connection, batch_size=1000):
+        """
+        Adds the doses missing from the schedule of the children.
+
+        The children are streamed in pages, and only the scheduled,
+        administered and notified doses of the current page are loaded, so
+        the memory used does not grow with the number of children.
+        """
+        doses = connection.execute(select(Dose.id, Dose.term)
+                                   .where(Dose.term.isnot(None))).all()
+        page = []
+        children = self.iter(Child, Child.birthdate.isnot(None),
+                             batch_size=batch_size,
+                             columns=[Child.id, Child.parent_id,
+                                      Child.birthdate])
+        for child in children:
+            page.append(child)
+            if len(page) == batch_size:
+                self.__schedule_page(connection, page, doses)
+                page = []
+        if page:
+            self.__schedule_page(connection, page, doses)
+
+    def __schedule_page(self, connection, children, doses):
+        """Adds the doses missing from the schedule of a page of children"""
+        table = Child_Dose_Schedule.__table__
+        child_ids = [child_id for child_id, _, _ in children]
+
+        def pairs(pairs_table):
+            """Returns the (child_id, dose_id) pairs of the page in a table"""
+            return {tuple(row) for row in connection.execute(
+                select(pairs_table.c.child_id, pairs_table.c.dose_id)
+                .where(pairs_table.c.child_id.in_(child_ids)))}
+
+        scheduled = pairs(table)
+        done = pairs(child_dose)
+        notified = pairs(child_dose_notifications)
+        rows = []
+        for child_id, parent_id, birthdate in children:
+            for dose_id, term in doses:
+                pair = (child_id, dose_id)
+                if pair in scheduled:
+                    continue
+                status = 'pending'
+                if pair in done:
+                    status = 'done'
+                elif pair in notified:
+                    status = 'notified'
+                rows.append({'child_id': child_id, 'dose_id': dose_id,
+                             'due_date': Child_Dose_Schedule.due_date_of(
+                                 birthdate, term),
+                             'status': status,
+                             'shard': Child_Dose_Schedule.shard_of(parent_id)})
+        if rows:
+            connection.execute(table.insert(), rows)
+
+    def __shard_schedule(self, connection):
+        """Moves the scheduled doses to the partition of their parent"""
+        table = Child_Dose_Schedule.__table__
+        shards = {}
+        children = connection.execute(
+            select(Child.id, Child.parent_id)
+            .where(Child.id.in_(select(table.c.child_id))))
+        for child_id, parent_id in children:
+            shards.setdefault(Child_Dose_Schedule.shard_of(parent_id),
+                              []).append(child_id)
+        for shard, child_ids in shards.items():
+            for index in range(0, len(child_ids), 1000):
+                connection.execute(table.update()
+                                   .where(table.c.child_id.in_(
+                                       child_ids[index:index + 1000]),
+                                          table.c.shard != shard)
+                                   .values(shard=shard))
+
+    def __merge_hospital_vaccines(self, connection):
+        """Merges the hospital_vaccine rows sharing the same pair"""
+        table = Hospital_Vaccine.__table__
+        duplicates = connection.execute(
+            select(table.c.hospital_id, table.c.vaccine_id)
+            .group_by(table.c.hospital_id, table.c.vaccine_id)
+            .having(func.count() > 1)).all()
+        for hospital_id, vaccine_id in duplicates:
+            rows = connection.execute(
+                select(table.c.id, table.c.quantity)
+                .where(table.c.hospital_id == hospital_id,
+                       table.c.vaccine_id == vaccine_id)
+                .order_by(table.c.id)).all()
+            quantity = sum(row.quantity or 0 for row in rows)
+            connection.execute(table.update()
+                               .where(table.c.id == rows[0].id)
+                               .values(quantity=quantity))
+            connection.execute(table.delete().where(
+                table.c.id.in_([row.id for row in rows[1:]])))
 
     def get_by_id(self, cls, id):
         """
         Get an object by its ID.
 
+        Looks the object up in the session identity map first and falls back
+        to a single primary-key query, so the table is never loaded as a whole.
+
         Args:
         - cls: The class of the object to retrieve.
         - id: The ID of the object.
@@ -98,9 +1024,27 @@ class DBStorage:
         Returns:
         - The object retrieved by ID if found, else None.
         """
-        key = "{}.{}".format(cls.__name__, id)
-        return self.all(cls).get(key)
-    
+        if id is None:
+            return None
+        return self.__session.get(cls, id)
+
+    def get_many(self, cls, ids):
+        """
+        Get several objects by their IDs with a single query.
+
+        Args:
+        - cls: The class of the objects to retrieve.
+        - ids: An iterable of IDs, duplicates and None values are ignored.
+
+        Returns:
+        - A dictionary of the objects found, keyed by their ID.
+        """
+        ids = {id for id in ids if id is not None}
+        if not ids:
+            return {}
+        objects = self.__session.query(cls).filter(cls.id.in_(ids)).all()
+        return {obj.id: obj for obj in objects}
+
     def get_by_email(self, cls, email):
         """
         Get an object by its email attribute.
@@ -127,18 +1071,34 @@ class DBStorage:
         """
         return self.__session.query(cls).filter_by(token=token).first()
     
-    def count(self, cls=None):
+    def count(self, cls=None, *criteria, **filters):
         """
         Count the number of objects in storage.
 
+        The count is computed by the database with a single COUNT(*) query,
+        no object is loaded into the session.
+
         Args:
-        - cls: The class of objects to count. If None, counts all objects.
+        - cls: The class of objects to count. If None, counts all objects
+          and the filters are ignored.
+        - criteria: Optional SQLAlchemy filter expressions,
+          e.g. Child.birthdate > date.
+        - filters: Optional column equality filters,
+          e.g. hospital_id=hospital.id.
 
         Returns:
         - The count of objects.
         """
-        return len(self.all(cls))
-    
+        if cls is None:
+            classes = [mapper.class_ for mapper in Base.registry.mappers]
+            return sum(self.count(mapped_cls) for mapped_cls in classes)
+        query = self.__session.query(func.count()).select_from(cls)
+        if criteria:
+            query = query.filter(*criteria)
+        if filters:
+            query = query.filter_by(**filters)
+        return query.scalar()
+
     def close(self):
-        """Close the session"""
+        """Close the session, discarding any uncommitted unit of work"""
         self.__session.remove()
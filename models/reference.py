@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+"""Module defining the in-process cache of reference data"""
+
+
+class Reference:
+    """
+    Read-only snapshot of a small, rarely changing table.
+
+    Rows are immutable and detached from any session, so a snapshot can be
+    shared by every request of a worker until the data changes.
+
+    Attributes:
+    - rows: All the rows, sorted by denomination (or name).
+    - by_id: The rows keyed by ID.
+    - by_denomination: The rows keyed by denomination, if the table has one.
+    - by_vaccine_id: Tuples of rows keyed by vaccine ID, if the table has one.
+    """
+
+    def __init__(self, rows):
+        """
+        Builds the snapshot and its indexes.
+
+        Args:
+        - rows: The rows of the table, as returned by a query on its columns.
+        """
+        rows = list(rows)
+        keys = rows[0]._fields if rows else ()
+        sort_key = 'denomination' if 'denomination' in keys else 'name'
+        if sort_key in keys:
+            rows.sort(key=lambda row: getattr(row, sort_key) or '')
+        self.rows = tuple(rows)
+        self.by_id = {row.id: row for row in self.rows}
+        self.by_denomination = {}
+        self.by_vaccine_id = {}
+        if 'denomination' in keys:
+            self.by_denomination = {row.denomination: row
+                                    for row in self.rows}
+        if 'vaccine_id' in keys:
+            by_vaccine_id = {}
+            for row in self.rows:
+                by_vaccine_id.setdefault(row.vaccine_id, []).append(row)
+            self.by_vaccine_id = {key: tuple(value)
+                                  for key, value in by_vaccine_id.items()}
+
+    def get(self, id):
+        """
+        Get a row by its ID.
+
+        Args:
+        - id: The ID of the row.
+
+        Returns:
+        - The row if found, else None.
+        """
+        return self.by_id.get(id)
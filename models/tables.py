@@ -1,13 +1,19 @@
 #!/bin/use/python3
 """Module defining database models for the vaccination reminder app."""
+from datetime import datetime, timedelta
 from flask_login import UserMixin
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Table
+from sqlalchemy import (Boolean, Column, Date, DateTime, ForeignKey, Index,
+                        Integer, String, Table, Text)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import uuid
+import zlib
 
 Base = declarative_base()
 
+# Number of partitions of the reminder job, see Child_Dose_Schedule.shard
+REMINDER_SHARDS = 16
+
 
 class BaseModel():
     """Base model for database objects"""
@@ -33,17 +39,113 @@ child_dose = Table('child_dose', Base.metadata,
 child_dose_notifications = Table(
     'child_dose_notifications',
     Base.metadata,
-    Column('child_id', String(60), ForeignKey('children.id')),
-    Column('dose_id', String(60), ForeignKey('doses.id')))
+    Column('child_id', String(60), ForeignKey('children.id'),
+           primary_key=True),
+    Column('dose_id', String(60), ForeignKey('doses.id'), primary_key=True))
+
+
+class Child_Dose_Schedule(BaseModel, Base):
+    """Model representing the due date of a dose for a child."""
+    __tablename__ = 'child_dose_schedule'
+    __table_args__ = (Index('ix_child_dose_schedule_shard_due_date',
+                            'shard', 'due_date'),
+                      Index('ix_child_dose_schedule_dose_id_status_due_date',
+                            'dose_id', 'status', 'due_date'))
+    child_id = Column(String(60), ForeignKey('children.id'), primary_key=True)
+    dose_id = Column(String(60), ForeignKey('doses.id'), primary_key=True)
+    due_date = Column(Date, nullable=False, index=True)
+    status = Column(String(16), default='pending', nullable=False)
+    shard = Column(Integer, default=0, nullable=False)
+
+    @staticmethod
+    def due_date_of(birthdate, term):
+        """Returns the day a child born on birthdate reaches term days of age"""
+        return birthdate.date() + timedelta(days=term - 1)
+
+    @staticmethod
+    def shard_of(parent_id):
+        """Returns the partition of the reminder job a parent belongs to"""
+        return zlib.crc32(parent_id.encode()) % REMINDER_SHARDS
 
 
 class Hospital_Vaccine(Base):
     """Model representing the link between hospitals and vaccines."""
     __tablename__ = 'hospital_vaccine'
+    __table_args__ = (Index('ix_hospital_vaccine_hospital_id_vaccine_id',
+                            'hospital_id', 'vaccine_id', unique=True),)
     id = Column(String(60), primary_key=True)
     quantity = Column(Integer, default=0)
     hospital_id = Column(String(60), ForeignKey('hospitals.id'))
-    vaccine_id = Column(String(60), ForeignKey('vaccines.id'))
+    vaccine_id = Column(String(60), ForeignKey('vaccines.id'), index=True)
+
+
+class Cache_Version(Base):
+    """Model representing the version of data cached by the app workers."""
+    __tablename__ = 'cache_versions'
+    name = Column(String(60), primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+
+
+class Job_Watermark(Base):
+    """Model representing the point up to which a periodic job has run."""
+    __tablename__ = 'job_watermarks'
+    name = Column(String(60), primary_key=True)
+    watermark = Column(Date, nullable=False)
+
+
+class Job_Worker(Base):
+    """Model representing a live worker of a partitioned job."""
+    __tablename__ = 'job_workers'
+    job = Column(String(60), primary_key=True)
+    owner = Column(String(128), primary_key=True)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class Job_Lease(Base):
+    """Model representing the lease of a partition of a job by a worker."""
+    __tablename__ = 'job_leases'
+    job = Column(String(60), primary_key=True)
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String(128))
+    expires_at = Column(DateTime, nullable=False)
+
+
+class Dashboard_Snapshot(Base):
+    """Model representing precomputed statistics of a dashboard."""
+    __tablename__ = 'dashboard_snapshots'
+    name = Column(String(60), primary_key=True)
+    data = Column(Text, nullable=False)
+    refreshed_at = Column(DateTime, nullable=False)
+
+
+class Email_Outbox(BaseModel, Base):
+    """Model representing an email waiting for delivery."""
+    __tablename__ = 'email_outbox'
+    __table_args__ = (Index('ix_email_outbox_status_next_attempt_at',
+                            'status', 'next_attempt_at'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    recipient = Column(String(128), nullable=False)
+    template = Column(String(64), nullable=False)
+    payload = Column(Text)
+    status = Column(String(16), default='pending', nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.now, nullable=False)
+    idempotency_key = Column(String(191), unique=True)
+    last_error = Column(String(512))
+    created_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime)
+
+
+class Stock_Movement(BaseModel, Base):
+    """Model representing an append-only change of a vaccine stock."""
+    __tablename__ = 'stock_movements'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    hospital_id = Column(String(60), ForeignKey('hospitals.id'))
+    vaccine_id = Column(String(60), ForeignKey('vaccines.id'), index=True)
+    delta = Column(Integer, nullable=False)
+    reason = Column(String(32))
+    created_at = Column(DateTime, default=datetime.now)
+    compacted = Column(Boolean, default=False, nullable=False, index=True)
 
 
 class Dose(BaseModel, Base):
@@ -52,7 +154,7 @@ class Dose(BaseModel, Base):
     id = Column(String(60), primary_key=True, default=str(uuid.uuid4()))
     denomination = Column(String(128), unique=True)
     term = Column(Integer)
-    vaccine_id = Column(String(60), ForeignKey('vaccines.id'))
+    vaccine_id = Column(String(60), ForeignKey('vaccines.id'), index=True)
 
 
 class Vaccine(BaseModel, Base):
@@ -75,10 +177,12 @@ class Child(BaseModel, Base):
     first_name = Column(String(128))
     last_name = Column(String(128))
     birthdate = Column(DateTime)
-    parent_id = Column(String(60), ForeignKey('users.id'))
+    parent_id = Column(String(60), ForeignKey('users.id'), index=True)
     doses = relationship('Dose', secondary=child_dose, backref='child')
     doses_notified = relationship('Dose', secondary=child_dose_notifications,
                                   backref='notified_child')
+    schedule = relationship('Child_Dose_Schedule',
+                            cascade="all, delete, delete-orphan")
 
 
 class User(BaseModel, Base, UserMixin):
@@ -90,10 +194,14 @@ class User(BaseModel, Base, UserMixin):
     first_name = Column(String(128))
     last_name = Column(String(128))
     status = Column(String(32))
-    token = Column(String(128))
+    token = Column(String(128), index=True)
     children = relationship('Child', backref="parent",
                             cascade="all, delete, delete-orphan")
 
+    def get_id(self):
+        """Returns the session ID of the user, tagged with its role."""
+        return 'user:{}'.format(self.id)
+
 
 class Nurse(BaseModel, Base, UserMixin):
     """Model representing nurses."""
@@ -104,8 +212,12 @@ class Nurse(BaseModel, Base, UserMixin):
     first_name = Column(String(128))
     last_name = Column(String(128))
     status = Column(String(32))
-    token = Column(String(128))
-    hospital_id = Column(String(60), ForeignKey('hospitals.id'))
+    token = Column(String(128), index=True)
+    hospital_id = Column(String(60), ForeignKey('hospitals.id'), index=True)
+
+    def get_id(self):
+        """Returns the session ID of the nurse, tagged with its role."""
+        return 'nurse:{}'.format(self.id)
 
 
 class Hospital(BaseModel, Base):
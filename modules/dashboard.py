@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+"""
+Statistics of the admin dashboard.
+
+The statistics are computed into a snapshot stored in the database, which the
+scheduler refreshes every 'DASHBOARD_TTL' seconds, so loading the dashboard
+only reads the snapshot, whatever the number of admins refreshing it.
+"""
+import os
+
+# Name of the snapshot of the admin dashboard statistics
+SNAPSHOT_NAME = 'admin'
+
+
+def dashboard_ttl():
+    """Returns the number of seconds a dashboard snapshot stays fresh"""
+    return int(os.getenv('DASHBOARD_TTL') or 300)
+
+
+def get_dashboard():
+    """
+    Gets the statistics of the admin dashboard from the snapshot.
+
+    The snapshot is only computed here when it is missing, or when it is
+    more than twice as old as 'DASHBOARD_TTL', i.e. when no scheduler is
+    refreshing it.
+
+    Returns:
+    - The statistics, as computed by compute_dashboard(), and the time they
+      were refreshed at.
+    """
+    from datetime import datetime, timedelta
+    import json
+    from models import storage
+    snapshot = storage.get_snapshot(SNAPSHOT_NAME)
+    if snapshot is None or datetime.now() - snapshot.refreshed_at > \
+            timedelta(seconds=2 * dashboard_ttl()):
+        return refresh_dashboard(), datetime.now()
+    return json.loads(snapshot.data), snapshot.refreshed_at
+
+
+def refresh_dashboard(force=True):
+    """
+    Computes the statistics of the admin dashboard into the snapshot.
+
+    Args:
+    - force: If False, the snapshot is only refreshed once it is older
+      than 'DASHBOARD_TTL'.
+
+    Returns:
+    - The statistics, or None if the snapshot was still fresh.
+    """
+    from datetime import datetime, timedelta
+    import json
+    from models import storage
+    from sqlalchemy.exc import IntegrityError
+    if not force:
+        snapshot = storage.get_snapshot(SNAPSHOT_NAME)
+        if snapshot is not None and datetime.now() - snapshot.refreshed_at < \
+                timedelta(seconds=dashboard_ttl()):
+            return None
+    dashboard = compute_dashboard()
+    storage.set_snapshot(SNAPSHOT_NAME, json.dumps(dashboard))
+    try:
+        storage.save()
+    except IntegrityError:
+        # Another worker stored the first snapshot at the same time
+        storage.rollback()
+    return dashboard
+
+
+def compute_dashboard():
+    """
+    Computes the statistics of the admin dashboard.
+
+    Returns:
+    - A dictionary with the overall 'statistics' (count of nurses, parents
+      and children), the 'nurses_count' per hospital, the
+      'vaccinated_child' count per dose and the 'vaccine_status' of the
+      stock.
+    """
+    from models import storage
+    from models.tables import Child, Nurse, User
+    return {
+        'statistics': {
+            'nurses': storage.count(Nurse),
+            'parents': storage.count(User) - 1,
+            'childs': storage.count(Child),
+        },
+        'nurses_count': nurses_by_hospital(),
+        'vaccinated_child': vaccinated_children(),
+        'vaccine_status': vaccine_stock(),
+    }
+
+
+def nurses_by_hospital():
+    """
+    Counts the number of nurses per hospital.
+
+    Counts the number of nurses associated with each hospital in the system with a single grouped
+    query over the nurses. Hospitals come from the reference data cache, so those without nurses
+    are listed with a count of zero. The function creates a list of tuples containing hospital
+    names and their respective nurse counts, sorted alphabetically by hospital name, and returns
+    this list.
+
+    Returns:
+    - A sorted list of tuples containing hospital names and the number of nurses associated with each
+      hospital in the system.
+
+    """
+    from models import storage
+    from models.tables import Hospital, Nurse
+    from sqlalchemy import func
+    hospitals = storage.reference(Hospital).rows
+    counts = dict(storage.query(Nurse, columns=[Nurse.hospital_id, func.count()],
+                                group_by=Nurse.hospital_id))
+    nurses_count = [(hospital.name, counts.get(hospital.id, 0))
+                    for hospital in hospitals]
+    return sorted(nurses_count)
+
+
+def vaccine_stock():
+    """
+    Checks and categorizes the stock status of vaccines.
+
+    Checks the stock level of each vaccine in the system and categorizes them based on predefined
+    thresholds. It retrieves all vaccines and their stock balances (the compacted stock plus the
+    recent stock movements) from storage, sets thresholds for low stock and surplus,
+    then iterates through each vaccine, determining its stock status (Low, Surplus, or Adequate).
+    The function creates a dictionary containing vaccine denominations as keys and their respective
+    stock levels and statuses. It sorts this dictionary alphabetically by vaccine denomination and
+    returns the sorted dictionary.
+
+    Returns:
+    - A sorted dictionary containing vaccine denominations as keys and their respective stock levels
+      along with categorized statuses (Low, Surplus, or Adequate).
+
+    """
+    from models import storage
+    from models.tables import Vaccine
+    vaccines = storage.reference(Vaccine).rows
+    stock = storage.get_stock()
+    low_stock_threshold = 500
+    surplus_threshold = 2000
+    vaccine_stock = {}
+
+    for vaccine in vaccines:
+        vaccine_data = {}
+        vaccine_data['stock'] = stock.get(vaccine.id, 0)
+        if vaccine_data['stock'] < low_stock_threshold:
+            vaccine_data['status'] = 'Low'
+        elif vaccine_data['stock'] > surplus_threshold:
+            vaccine_data['status'] = 'Surplus'
+        else:
+            vaccine_data['status'] = 'Adequate'
+        vaccine_stock[vaccine.denomination] = vaccine_data
+    sorted_dict = {k: vaccine_stock[k] for k in sorted(vaccine_stock)}
+    return sorted_dict
+
+
+def vaccinated_children():
+    """
+    Counts the number of vaccinated children per dose.
+
+    Counts the number of children who have received each dose in the system with a single grouped
+    query over the administered doses (child_dose). Doses come from the reference data cache, so
+    those never administered are listed with a count of zero. The function creates a list of tuples
+    containing dose denominations and the respective counts of vaccinated children for each dose,
+    sorted alphabetically by dose denomination, and returns this sorted list.
+
+    Returns:
+    - A sorted list of tuples containing dose denominations and the number of children who have received
+      each dose in the system.
+
+    """
+    from models import storage
+    from models.tables import Dose, child_dose
+    from sqlalchemy import func
+    doses = storage.reference(Dose).rows
+    counts = dict(storage.query(child_dose, columns=[child_dose.c.dose_id,
+                                                     func.count()],
+                                group_by=child_dose.c.dose_id))
+    vaccinated_children = [(dose.denomination, counts.get(dose.id, 0))
+                           for dose in doses]
+    return sorted(vaccinated_children)
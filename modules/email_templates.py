@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+"""
+Email templates.
+
+The emails are Jinja templates of templates/emails. Each template is compiled
+once per process and cached, with the shared stylesheet inlined when it is
+compiled, so rendering a message only runs the compiled template. A template
+sets the subject of the email along with its HTML content.
+"""
+from jinja2 import Environment, FileSystemLoader
+import os
+
+TEMPLATES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'templates', 'emails')
+
+# Placeholder of the templates replaced by the shared stylesheet
+STYLE_MARKER = '/* style.css */'
+
+
+class EmailLoader(FileSystemLoader):
+    """Loads the email templates, inlining the shared stylesheet."""
+
+    def get_source(self, environment, template):
+        """
+        Get the source of a template, with the stylesheet inlined.
+
+        Args:
+        - environment: The Jinja environment loading the template.
+        - template: The file name of the template.
+
+        Returns:
+        - The source, file name and up-to-date check of the template.
+        """
+        source, filename, uptodate = super().get_source(environment,
+                                                        template)
+        if STYLE_MARKER in source:
+            with open(os.path.join(self.searchpath[0], 'style.css')) as style:
+                source = source.replace(STYLE_MARKER, style.read())
+        return source, filename, uptodate
+
+
+environment = Environment(loader=EmailLoader(TEMPLATES_DIR), autoescape=True,
+                          auto_reload=False)
+
+
+def render(name, **context):
+    """
+    Render an email template.
+
+    Args:
+    - name: The file name of the template, e.g. 'verification.html'.
+    - context: The variables of the template.
+
+    Returns:
+    - The subject and the HTML content of the email.
+    """
+    return render_many(name, [context])[0]
+
+
+def render_many(name, contexts):
+    """
+    Render an email template for a batch of messages.
+
+    The template is looked up and compiled once for the whole batch.
+
+    Args:
+    - name: The file name of the template, e.g. 'reminder.html'.
+    - contexts: An iterable of dictionaries, the variables of each message.
+
+    Returns:
+    - A list of (subject, HTML content) tuples, in the order of the contexts.
+    """
+    template = environment.get_template(name)
+    emails = []
+    for context in contexts:
+        module = template.make_module(context)
+        emails.append((module.subject, str(module)))
+    return emails
@@ -1,45 +1,83 @@
 #!usr/bin/python3
+from functools import wraps
 
-def redirect_user(currentuser):
-    """Redirects users based on their roles.
+# Home page of each role
+ROLE_HOMES = {
+    'Admin': 'app_views.admin_home',
+    'Nurse': 'app_views.nurse_home',
+    'User': 'app_views.user_home',
+}
 
-    Args:
-    - currentuser: Object representing the current user.
+
+def current_role():
+    """Resolves the role of the current user once per request.
 
     Returns:
-    - Redirects to different views based on user roles:
-      - If currentuser is 'Admin' and (user or nurse) exists:
-        - If currentuser's email is not the admin email, redirects to user's home.
-        - If nurse exists, redirects to nurse's home.
-      - If currentuser is 'User' and (user or nurse) exists:
-        - If currentuser's email is the admin email, redirects to admin's home.
-        - If nurse exists, redirects to nurse's home.
-      - If conditions do not match, redirects based on currentuser's email:
-        - If currentuser's email is the admin email, redirects to admin's home.
-        - If currentuser's email is not the admin email, redirects to user's home.
-
-    If no redirection matches the conditions, returns None.
+    - 'Admin' if the current user is the admin, 'Nurse' for a nurse, 'User'
+      for any other user, or None if no user is logged in.
+
+    Notes:
+    - The role is derived from the object loaded by the login manager, so no
+      additional database query is made, and it is cached on flask.g for the
+      rest of the request.
     """
-    from flask import redirect, url_for
+    from flask import g
     from flask_login import current_user
-    from models import storage
     from models.tables import Nurse, User
     import os
-    user = storage.get_by_id(User, current_user.id)
-    nurse = storage.get_by_id(Nurse, current_user.id)
-    if currentuser == 'Admin' and (user or nurse):
-        if user and user.email != os.getenv('ADMIN_EMAIL'):
-            return redirect(url_for('app_views.user_home'))
-        elif nurse:
-            return redirect(url_for('app_views.nurse_home'))
-    elif currentuser == 'User' and (user or nurse):
-        if user and user.email == os.getenv('ADMIN_EMAIL'):
-            return redirect(url_for('app_views.admin_home'))
-        elif nurse:
-            return redirect(url_for('app_views.nurse_home'))
-    else:
-        if user and user.email == os.getenv('ADMIN_EMAIL'):
-            return redirect(url_for('app_views.admin_home'))
-        elif user and user.email != os.getenv('ADMIN_EMAIL'):
-            return redirect(url_for('app_views.user_home'))
-    return None
+    if 'role' not in g:
+        role = None
+        if isinstance(current_user, Nurse):
+            role = 'Nurse'
+        elif isinstance(current_user, User):
+            if current_user.email == os.getenv('ADMIN_EMAIL'):
+                role = 'Admin'
+            else:
+                role = 'User'
+        g.role = role
+    return g.role
+
+
+def redirect_user(*currentuser):
+    """Redirects users based on their roles.
+
+    Args:
+    - currentuser: The role(s) allowed to access the page: 'Admin', 'User'
+      or 'Nurse'.
+
+    Returns:
+    - None if the current user has one of the allowed roles (or is not
+      logged in), else a redirection to the home page of its role:
+      - 'Admin' is redirected to admin's home.
+      - 'User' is redirected to user's home.
+      - 'Nurse' is redirected to nurse's home.
+    """
+    from flask import redirect, url_for
+    role = current_role()
+    if role is None or role in currentuser:
+        return None
+    return redirect(url_for(ROLE_HOMES[role]))
+
+
+def role_required(*roles):
+    """Route decorator restricting a view to the given roles.
+
+    Args:
+    - roles: The roles allowed to access the view: 'Admin', 'User' or 'Nurse'.
+
+    Returns:
+    - A decorator redirecting users with other roles to their home page.
+
+    Notes:
+    - Must be applied below 'login_required' so anonymous users are sent to
+      the login page first.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            redirection = redirect_user(*roles)
+            if redirection:
+                return redirection
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
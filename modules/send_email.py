@@ -1,35 +1,281 @@
 #!/usr/bin/python3
+"""
+Outbound email delivery.
 
-def send_email(subject, html_content, receiver):
-    """Sends emails to users.
+Messages are built in the request and put on an in-process queue, a pool of
+background threads delivers them through the configured transport so the
+request never waits on the mail server.
+"""
+from email.message import EmailMessage
+import atexit
+import logging
+from modules.smtp_pool import get_pool
+import os
+import queue
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket limiting the rate of outbound messages across threads."""
+
+    def __init__(self, rate, capacity=None):
+        """
+        Initialize the bucket, full.
+
+        Args:
+        - rate: Number of tokens added per second.
+        - capacity: Maximum number of tokens, the size of a burst. Defaults
+          to one second worth of tokens.
+        """
+        self.rate = float(rate)
+        self.capacity = max(float(capacity or self.rate), 1.0)
+        self.__tokens = self.capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting for one to be added if the bucket is empty"""
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity, self.__tokens +
+                                    (now - self.__updated) * self.rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+
+
+class SMTPTransport:
+    """Delivers messages through pooled sessions on the SMTP server of the sender account."""
+
+    def __init__(self, host=None, port=None, username=None, password=None):
+        """
+        Initialize the transport.
+
+        Args:
+        - host: SMTP server, defaults to 'MAIL_SERVER' or smtp.gmail.com.
+        - port: SMTP SSL port, defaults to 'MAIL_PORT' or 465.
+        - username: Sender account, defaults to 'MAIL_USERNAME'.
+        - password: Sender password, defaults to 'MAIL_PASSWORD'.
+        """
+        self.host = host or os.getenv('MAIL_SERVER') or 'smtp.gmail.com'
+        self.port = int(port or os.getenv('MAIL_PORT') or 465)
+        self.username = username or os.getenv('MAIL_USERNAME')
+        self.password = password or os.getenv('MAIL_PASSWORD')
+        self.pool = get_pool(self.host, self.port, self.username,
+                             self.password)
+        rate = float(os.getenv('MAIL_RATE_LIMIT') or 0)
+        self.bucket = None
+        if rate > 0:
+            self.bucket = TokenBucket(rate, os.getenv('MAIL_RATE_BURST'))
+
+    def send(self, email):
+        """
+        Sends a message on a pooled, already logged-in session.
+
+        Waits first for the rate limiter, if any, so the messages of every
+        thread of the process stay within 'MAIL_RATE_LIMIT'. The limiter is
+        per process: the limit must be the quota of the provider divided by
+        the number of processes sending emails.
+
+        Args:
+        - email: The EmailMessage to send.
+        """
+        if self.bucket is not None:
+            self.bucket.acquire()
+        self.pool.send_message(email)
+
+
+class FileTransport:
+    """Writes messages as .eml files instead of sending them (tests, benchmarks)."""
+
+    def __init__(self, directory=None):
+        """
+        Initialize the transport.
+
+        Args:
+        - directory: Directory receiving the messages, defaults to
+          'MAIL_OUTBOX_DIR' or ./outbox.
+        """
+        self.directory = directory or os.getenv('MAIL_OUTBOX_DIR') or 'outbox'
+        os.makedirs(self.directory, exist_ok=True)
+
+    def send(self, email):
+        """
+        Writes a message to the outbox directory.
+
+        Args:
+        - email: The EmailMessage to write.
+        """
+        path = os.path.join(self.directory, '{}.eml'.format(uuid.uuid4()))
+        with open(path, 'wb') as file:
+            file.write(email.as_bytes())
+
+
+_transport = None
+
+
+def get_transport():
+    """
+    Returns the transport selected by the 'MAIL_TRANSPORT' environment variable.
+
+    The transport is built once per process, so the web app queue and the
+    scheduler share the same pool of SMTP sessions.
+
+    Returns:
+    - A FileTransport if 'MAIL_TRANSPORT' is 'file', else an SMTPTransport.
+    """
+    global _transport
+    if _transport is None:
+        if os.getenv('MAIL_TRANSPORT', 'smtp').lower() == 'file':
+            _transport = FileTransport()
+        else:
+            _transport = SMTPTransport()
+    return _transport
+
+
+class EmailQueue:
+    """Queue of outbound messages drained by a pool of background threads."""
+
+    def __init__(self, transport=None, workers=None, retries=3):
+        """
+        Initialize the queue, the worker threads are started on first use.
+
+        Args:
+        - transport: Object with a send(email) method, defaults to the
+          transport returned by get_transport().
+        - workers: Number of delivery threads, defaults to 'MAIL_WORKERS' or 2.
+        - retries: Number of attempts made for each message.
+        """
+        self.transport = transport
+        self.workers = int(workers or os.getenv('MAIL_WORKERS') or 2)
+        self.retries = retries
+        self.__queue = queue.Queue()
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+    def set_transport(self, transport):
+        """
+        Replaces the transport used to deliver the messages.
+
+        Args:
+        - transport: Object with a send(email) method.
+        """
+        self.transport = transport
+
+    def put(self, email):
+        """
+        Queues a message for delivery.
+
+        Args:
+        - email: The EmailMessage to deliver.
+        """
+        self.__start()
+        self.__queue.put(email)
+
+    def join(self, timeout=None):
+        """
+        Waits until the queued messages are delivered.
+
+        Args:
+        - timeout: Maximum number of seconds to wait, None waits forever.
+
+        Returns:
+        - True if the queue was drained, else False.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.__queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def __start(self):
+        """Starts the worker threads of the current process"""
+        if self.__threads:
+            return
+        with self.__lock:
+            if self.__threads:
+                return
+            if self.transport is None:
+                self.transport = get_transport()
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self.__work, daemon=True)
+                thread.start()
+                self.__threads.append(thread)
+
+    def __work(self):
+        """Delivers the queued messages"""
+        while True:
+            email = self.__queue.get()
+            try:
+                self.__deliver(email)
+            finally:
+                self.__queue.task_done()
+
+    def __deliver(self, email):
+        """Sends a message, retrying with a growing delay on failure"""
+        for attempt in range(1, self.retries + 1):
+            try:
+                self.transport.send(email)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception('Email to %s dropped after %d attempts',
+                                     email['To'], attempt)
+                    return
+                time.sleep(2 ** attempt)
+
+
+email_queue = EmailQueue()
+# Give the queued messages a chance to leave on a graceful shutdown
+atexit.register(email_queue.join, 30)
+
+
+def build_email(subject, html_content, receiver):
+    """Builds an HTML email.
 
     Args:
     - subject: Subject line for the email.
     - html_content: HTML content of the email.
     - receiver: Email address of the receiver.
 
-    Note:
-    - Requires 'MAIL_USERNAME' and 'MAIL_PASSWORD' environment variables for sender authentication.
+    Returns:
+    - The EmailMessage, sent from the 'MAIL_USERNAME' account.
     """
-    from email.message import EmailMessage
-    import os
-    import smtplib
-    import ssl
-
-    sender = os.getenv('MAIL_USERNAME')
-    password = os.getenv('MAIL_PASSWORD')
-
     email = EmailMessage()
-    email['From'] = sender
+    email['From'] = os.getenv('MAIL_USERNAME')
     email['Subject'] = subject
     email['To'] = receiver
     email.add_alternative(html_content, subtype='html')
+    return email
 
-    context = ssl.create_default_context()
 
-    host = 'smtp.gmail.com'
-    port = 465
+def send_email(subject, html_content, receiver):
+    """Sends emails to users.
 
-    with smtplib.SMTP_SSL(host, port, context=context) as smtp:
-        smtp.login(sender, password)
-        smtp.send_message(email)
+    The email is queued and delivered by a background thread, so the
+    caller does not wait for the mail server. Inside the unit of work of a
+    request, it is only queued once the unit of work is committed, so no
+    email leaves for changes that are rolled back.
+
+    Args:
+    - subject: Subject line for the email.
+    - html_content: HTML content of the email.
+    - receiver: Email address of the receiver.
+
+    Note:
+    - Requires 'MAIL_USERNAME' and 'MAIL_PASSWORD' environment variables for sender authentication.
+    - Set 'MAIL_TRANSPORT' to 'file' to write the emails to 'MAIL_OUTBOX_DIR' instead of sending them.
+    """
+    from functools import partial
+    from models import storage
+    email = build_email(subject, html_content, receiver)
+    storage.after_commit(partial(email_queue.put, email))
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""
+Pool of authenticated SMTP sessions.
+
+Opening an SMTP session costs a TCP connection, a TLS handshake and a login.
+The pool keeps sessions open and hands them out again, so the cost is paid
+once per session instead of once per message.
+"""
+from contextlib import contextmanager
+import atexit
+import os
+import smtplib
+import ssl
+import threading
+import time
+
+# Errors about a single message, the session itself is still usable
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                  smtplib.SMTPDataError)
+
+
+class PooledSMTP:
+    """An open SMTP session and its usage counters."""
+
+    def __init__(self, smtp):
+        """
+        Initialize the pooled session.
+
+        Args:
+        - smtp: The logged-in smtplib.SMTP_SSL session.
+        """
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        """Closes the session, ignoring errors of an already broken one"""
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+
+class SMTPPool:
+    """Thread-safe pool of logged-in SMTP sessions."""
+
+    def __init__(self, host, port, username, password, max_connections=None,
+                 max_messages=None, check_after=30, idle_timeout=240):
+        """
+        Initialize the pool, sessions are opened on demand.
+
+        Args:
+        - host: SMTP server.
+        - port: SMTP SSL port.
+        - username: Account used to log in.
+        - password: Password of the account.
+        - max_connections: Maximum number of open sessions, defaults to
+          'MAIL_POOL_SIZE' or 2.
+        - max_messages: Number of messages after which a session is
+          recycled, defaults to 'MAIL_MAX_MESSAGES' or 100.
+        - check_after: Idle seconds after which a session is checked with
+          NOOP before being reused.
+        - idle_timeout: Idle seconds after which a session is closed.
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_connections = int(max_connections or
+                                   os.getenv('MAIL_POOL_SIZE') or 2)
+        self.max_messages = int(max_messages or
+                                os.getenv('MAIL_MAX_MESSAGES') or 100)
+        self.check_after = check_after
+        self.idle_timeout = idle_timeout
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(self.max_connections)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a logged-in session from the pool.
+
+        Blocks while 'max_connections' sessions are in use. The session is
+        given back to the pool when the block ends, or closed if the block
+        raised an error other than a message-level one.
+
+        Yields:
+        - The smtplib.SMTP_SSL session.
+        """
+        self.__slots.acquire()
+        try:
+            pooled = self.__checkout()
+            try:
+                yield pooled.smtp
+            except MESSAGE_ERRORS:
+                self.__checkin(pooled)
+                raise
+            except BaseException:
+                pooled.close()
+                raise
+            pooled.sent += 1
+            self.__checkin(pooled)
+        finally:
+            self.__slots.release()
+
+    def send_message(self, email):
+        """
+        Sends a message on a pooled session.
+
+        A session closed by the server while idle is replaced and the message
+        sent again once.
+
+        Args:
+        - email: The EmailMessage to send.
+        """
+        try:
+            with self.connection() as smtp:
+                smtp.send_message(email)
+        except smtplib.SMTPServerDisconnected:
+            with self.connection() as smtp:
+                smtp.send_message(email)
+
+    def close(self):
+        """Closes the idle sessions"""
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for pooled in idle:
+            pooled.close()
+
+    def __checkout(self):
+        """Returns a healthy idle session, or opens a new one"""
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                pooled = self.__idle.pop()
+            idle_for = time.monotonic() - pooled.last_used
+            if idle_for > self.idle_timeout:
+                pooled.close()
+            elif idle_for > self.check_after and not self.__healthy(pooled):
+                pooled.close()
+            else:
+                return pooled
+        return PooledSMTP(self.__connect())
+
+    def __checkin(self, pooled):
+        """Gives a session back, or closes it once it sent enough messages"""
+        if pooled.sent >= self.max_messages:
+            pooled.close()
+            return
+        pooled.last_used = time.monotonic()
+        with self.__lock:
+            self.__idle.append(pooled)
+
+    def __healthy(self, pooled):
+        """Checks with NOOP that a session is still open"""
+        try:
+            return pooled.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def __connect(self):
+        """Opens and logs in a new session"""
+        context = ssl.create_default_context()
+        smtp = smtplib.SMTP_SSL(self.host, self.port, context=context)
+        try:
+            smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, username, password):
+    """
+    Returns the pool of the process for an SMTP account.
+
+    Args:
+    - host: SMTP server.
+    - port: SMTP SSL port.
+    - username: Account used to log in.
+    - password: Password of the account.
+
+    Returns:
+    - The SMTPPool shared by every caller using the same account.
+    """
+    key = (host, port, username)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = SMTPPool(host, port, username, password)
+        return _pools[key]
+
+
+@atexit.register
+def close_pools():
+    """Closes the sessions of every pool"""
+    for pool in list(_pools.values()):
+        pool.close()
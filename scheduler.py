@@ -1,125 +1,333 @@
 #!/usr/bin/python3
 
-def send_emails():
+# Wording of the reminders, by number of days before the dose term
+REMINDER_DELAYS = {2: 'in 2 days', 1: 'for tomorrow', 0: 'for today'}
+
+# Lifetime of the leases of the reminder job partitions, and the delay
+# between the heartbeats renewing them
+LEASE_SECONDS = 90
+HEARTBEAT_SECONDS = 30
+
+# Number of seconds a claimed email of the outbox is leased to its sender
+EMAIL_LEASE_SECONDS = 300
+
+
+def send_emails(shards=None, worker=None, batch_size=500, max_catch_up=7,
+                digest=None):
     """
     Sends vaccination reminder emails to parents.
 
-    Retrieves vaccination doses and children's information from storage
-    to create notifications for upcoming vaccinations. It then sends
-    personalized email reminders to parents using Gmail's SMTP server.
+    Retrieves the doses falling due within two days for children not yet
+    notified from the schedule, with range queries, to create notifications
+    for upcoming vaccinations. The reminders are written to the email
+    outbox in bulk, in the same transactions that record them as notified,
+    then delivered by deliver_emails().
 
     Notes:
-    - Sends reminders based on vaccination dose terms and children's ages.
-    - Notifications are appended to the list only if the vaccination dose
-      is within two days of the child's required term and hasn't been
-      previously notified.
-    - Utilizes HTML content in emails to provide clear vaccination details.
+    - Sends reminders based on the due dates scheduled for the children.
+    - The reminders are split into partitions (shards) by a hash of the
+      parent ID, each with its own watermark, so several workers can share
+      the job by leasing different partitions, and the reminders of a
+      parent are always handled by the same worker.
+    - The scan of a partition starts at its watermark, the day of its last
+      successful run, so the doses that fell due while the scheduler was
+      down are still reminded, up to 'max_catch_up' days back.
+    - Reminders are queued in batches of 'batch_size', each committed on
+      its own; the watermark moves with the last one. In digest mode, a
+      batch is extended to the last reminder of its last parent.
+    - Each reminder has an idempotency key, so a reminder is queued at
+      most once per child, dose and due date.
+    - In digest mode, the reminders due for a parent are grouped into a
+      single email. The window moves once a day, so a parent gets at most
+      one digest a day, except for the children added during the day.
 
+    Args:
+    - shards: The partitions to process. If None, processes all of them.
+    - worker: The name of the worker holding the leases of the partitions.
+      If given, the leases are renewed after each batch and a partition
+      taken over by another worker is left.
+    - batch_size: Number of reminders queued per transaction.
+    - max_catch_up: Number of days of missed reminders caught up.
+    - digest: Whether to group the reminders of a parent. If None, the
+      MAIL_DIGEST environment variable is used.
     """
-    from datetime import datetime
-    from email.message import EmailMessage
+    from datetime import date, timedelta
+    import json
     from models import storage
-    from models.tables import Dose, Child, User
-    import os
-    import ssl
-    import smtplib
-    doses = storage.all(Dose).values()
-    children = storage.all(Child).values()
-    print('children number: ', storage.count(Child))
-    notifications = []
-    current_date = datetime.now()
-    for dose in doses:
-        for child in children:
-            age_in_days = (current_date - child.birthday).days + 1
-            parent = storage.get_by_id(User, child.parent_id)
-            # Send the notification at most two days before
-            if dose.term == (age_in_days + 2) and dose not in child.doses_notified:
-                notifications.append([dose, parent, child, 'in 2 days'])
-            elif dose.term == (age_in_days + 1) and dose not in child.doses_notified:
-                notifications.append([dose, parent, child, 'for tomorrow'])
-            elif dose.term == age_in_days and dose not in child.doses_notified:
-                notifications.append([dose, parent, child, 'for today'])
-    email_sender = os.getenv('MAIL_USERNAME')
-    email_password = os.getenv('MAIL_PASSWORD')
-    subject = 'Vaccination reminder'
-    print('notifications: ', len(notifications))
-    for notificatin in notifications:
-        em = EmailMessage()
-        em['From'] = email_sender
-        em['Subject'] = subject
-        html_content = f"""
-        <html>
-            <head>
-                <style>
-                    body {{
-                        font-family: Arial, sans-serif;
-                        line-height: 1.6;
-                        color: #333;
-                        margin: 20px;
-                    }}
-                    .header {{
-                        text-align: center;
-                        margin-bottom: 20px;
-                    }}
-                    .reminder {{
-                        font-size: 16px;
-                        margin-bottom: 15px;
-                    }}
-                    .contact-info {{
-                        font-style: italic;
-                    }}
-                    .signature {{
-                        font-weight: bold;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="header">
-                    <h2>Hi {notificatin[1].first_name}!</h2>
-                    <p>This is a friendly reminder from VaxWise.</p>
-                </div>
-                <div class="reminder">
-                    <p>
-                        Just a reminder that your child's
-                         {notificatin[2].first_name} {notificatin[0].denomination}
-                         vaccination is scheduled {notificatin[3]}.
-                         Please ensure your child's timely visit to
-                         the medical center.
-                    </p>
-                </div>
-                <div class="contact-info">
-                    <p>
-                        If you have any questions or need further
-                         information about the vaccination, don't
-                         hesitate to contact your medical center
-                         directly.
-                         They can provide the necessary guidance
-                         and support:
-                    </p>
-                </div>
-                <div class="signature">
-                    <p>Best Regards,<br>VaxWise Team</p>
-                </div>
-            </body>
-        </html>
-        """
-        email_receiver = notificatin[1].email
-        em['To'] = email_receiver
-        em.add_alternative(html_content, subtype='html')
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465, context=context) as smtp:
-            smtp.login(email_sender, email_password)
-            smtp.send_message(em)
-            notificatin[2].doses_notified.append(notificatin[0])
+    from models.tables import REMINDER_SHARDS
+    from os import getenv
+    if digest is None:
+        digest = getenv('MAIL_DIGEST', '') not in ('', '0')
+    if shards is None:
+        shards = range(REMINDER_SHARDS)
+    today = date.today()
+    end = today + timedelta(days=3)
+    notifications = 0
+    for shard in shards:
+        name = 'reminders:{}'.format(shard)
+        start = max(storage.get_watermark(name) or today,
+                    today - timedelta(days=max_catch_up))
+        while True:
+            due_doses = storage.get_due_doses(start, end, limit=batch_size,
+                                              shard=shard)
+            full = len(due_doses) == batch_size
+            if digest and full:
+                # Finish the reminders of the last parent, so the batch
+                # does not split its digest into two emails
+                parent_id = due_doses[-1].parent_id
+                while due_doses and due_doses[-1].parent_id == parent_id:
+                    due_doses.pop()
+                due_doses.extend(storage.get_due_doses(
+                    start, end, shard=shard, parent_id=parent_id))
+            groups = []
+            for due in due_doses:
+                if digest and groups and groups[-1][0].parent_id == \
+                        due.parent_id:
+                    groups[-1].append(due)
+                else:
+                    groups.append([due])
+            emails = []
+            for group in groups:
+                reminders = []
+                for due in group:
+                    days = (due.due_date - today).days
+                    when = REMINDER_DELAYS.get(
+                        days, 'for {:%B %d}'.format(due.due_date))
+                    reminders.append({'child': due.child_name,
+                                      'dose': due.denomination,
+                                      'when': when})
+                payload = {'parent': group[0].parent_name,
+                           'reminders': reminders}
+                emails.append({
+                    'recipient': group[0].email,
+                    'template': 'reminder',
+                    'payload': json.dumps(payload),
+                    'idempotency_key': 'reminder:{}:{}:{}'.format(
+                        group[0].child_id, group[0].dose_id,
+                        group[0].due_date),
+                })
+            storage.add_notifications((due.child_id, due.dose_id)
+                                      for due in due_doses)
+            storage.add_emails(emails)
+            if not full:
+                storage.set_watermark(name, today)
             storage.save()
-            print('notifications sent')
+            notifications += len(due_doses)
+            if not full:
+                break
+            if worker and shard not in claim_shards(worker):
+                break
+    print('notifications: ', notifications)
     storage.close()
 
 
+def claim_shards(worker):
+    """
+    Claims a fair share of the partitions of the reminder job.
+
+    Also serves as the heartbeat of the worker: its leases last
+    LEASE_SECONDS, so the partitions of a dead worker are taken over by the
+    others once they expire.
+
+    Args:
+    - worker: A name unique to the worker.
+
+    Returns:
+    - The list of the partitions held by the worker.
+    """
+    from models import storage
+    from models.tables import REMINDER_SHARDS
+    return storage.claim_leases('reminders', worker, REMINDER_SHARDS,
+                                LEASE_SECONDS)
+
+
+def deliver_emails(batch_size=100, max_attempts=5, workers=None,
+                   worker=None):
+    """
+    Delivers the emails of the outbox.
+
+    Claims the due emails in batches, renders each batch with a single
+    lookup of each compiled template, and sends them concurrently from a
+    pool of threads over the pooled SMTP sessions shared with the web app,
+    within the rate limit of the transport. The outcome of a batch is
+    recorded with a single commit once all its emails are sent. A failed
+    email is retried later with an exponential backoff, and marked as
+    failed after 'max_attempts'.
+
+    Notes:
+    - The emails of a batch are leased for EMAIL_LEASE_SECONDS. The batch
+      is capped to what the rate limit lets through in half a lease, and
+      the lease is renewed while the emails are being sent, so another
+      worker never claims them again mid-batch.
+    - Delivery can outlast the leases of the reminder partitions, so the
+      heartbeat of 'worker' keeps running while it sends.
+
+    Args:
+    - batch_size: Number of emails claimed at once.
+    - max_attempts: Number of attempts made for each email.
+    - workers: Number of sending threads, defaults to 'MAIL_WORKERS' or 2.
+      Threads beyond 'MAIL_POOL_SIZE' wait for a free SMTP session.
+    - worker: The name of the worker holding partitions of the reminder
+      job, whose leases are renewed during the delivery.
+
+    Returns:
+    - The number of emails sent.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from datetime import datetime, timedelta
+    import json
+    from models import storage
+    from modules.email_templates import render_many
+    from modules.send_email import build_email, get_transport
+    from os import getenv
+    transport = get_transport()
+    workers = int(workers or getenv('MAIL_WORKERS') or 2)
+    bucket = getattr(transport, 'bucket', None)
+    if bucket is not None:
+        batch_size = min(batch_size, max(int(
+            bucket.capacity + bucket.rate * EMAIL_LEASE_SECONDS / 2), 1))
+    heartbeat = min(HEARTBEAT_SECONDS, EMAIL_LEASE_SECONDS / 3)
+    sent = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            emails = storage.claim_emails(batch_size, EMAIL_LEASE_SECONDS)
+            ids = [email.id for email in emails]
+            templates = {}
+            for email in emails:
+                templates.setdefault(email.template, []).append(email)
+            deliveries = []
+            for template, batch in templates.items():
+                try:
+                    contents = render_many(template + '.html',
+                                           [json.loads(email.payload)
+                                            for email in batch])
+                except Exception as error:
+                    contents = [error] * len(batch)
+                deliveries.extend(zip(batch, contents))
+            sending = []
+            for email, content in deliveries:
+                if not isinstance(content, Exception):
+                    subject, html_content = content
+                    content = executor.submit(transport.send, build_email(
+                        subject, html_content, email.recipient))
+                sending.append((email, content))
+            running = [result for _, result in sending
+                       if not isinstance(result, Exception)]
+            while running:
+                running = wait(running, timeout=heartbeat)[1]
+                if running:
+                    storage.extend_email_leases(ids, EMAIL_LEASE_SECONDS)
+                    if worker:
+                        claim_shards(worker)
+            for email, result in sending:
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    result.result()
+                except Exception as error:
+                    email.last_error = repr(error)[:512]
+                    if email.attempts >= max_attempts:
+                        email.status = 'failed'
+                    else:
+                        email.status = 'pending'
+                        email.next_attempt_at = datetime.now() + \
+                            timedelta(minutes=2 ** email.attempts)
+                else:
+                    email.status = 'sent'
+                    email.sent_at = datetime.now()
+                    sent += 1
+            storage.save()
+            if worker:
+                claim_shards(worker)
+            if len(emails) < batch_size:
+                break
+    print('notifications sent: ', sent)
+    storage.close()
+    return sent
+
+
+def compact_stock(batch_size=10000):
+    """
+    Rolls the vaccine stock movements into the stock counters.
+
+    Compacts the stock movements appended by the application in batches
+    until none is left, which keeps short the tail of movements added to
+    the counters when reading stock balances.
+
+    Args:
+    - batch_size: Number of movements compacted per transaction.
+    """
+    from models import storage
+    while storage.compact_stock(batch_size) == batch_size:
+        pass
+    storage.close()
+
+
+def refresh_dashboard():
+    """
+    Refreshes the snapshot of the admin dashboard statistics.
+
+    The snapshot is only recomputed once it is older than 'DASHBOARD_TTL',
+    so that several schedulers running at once do not all recompute it.
+    """
+    from models import storage
+    from modules.dashboard import refresh_dashboard
+    refresh_dashboard(force=False)
+    storage.close()
+
+
+def next_run(interval):
+    """
+    Computes the time to wait before the next run of the scheduler.
+
+    The scheduler wakes up at the next due boundary: midnight, when new
+    doses fall within the reminder window, the next email retry, or when
+    the dashboard snapshot goes stale, but waits at most 'interval' seconds
+    so the children added during the day and the stock movements are still
+    processed.
+
+    Args:
+    - interval: Maximum number of seconds to wait.
+
+    Returns:
+    - The number of seconds to wait.
+    """
+    from datetime import datetime, timedelta
+    from models import storage
+    from modules.dashboard import dashboard_ttl
+    now = datetime.now()
+    boundaries = [now.replace(hour=0, minute=0, second=0, microsecond=0) +
+                  timedelta(days=1), now + timedelta(seconds=interval),
+                  now + timedelta(seconds=dashboard_ttl())]
+    next_attempt = storage.next_email_attempt()
+    storage.close()
+    if next_attempt is not None:
+        boundaries.append(next_attempt)
+    return max((min(boundaries) - now).total_seconds(), 1)
+
+
 if __name__ == '__main__':
+    from models import storage
+    from os import getenv, getpid
+    import socket
     import time
-    # Loop to periodically send vaccination reminder emails
-    while True:
-        # Wait for 60 seconds
-        time.sleep(60)
-        send_emails()
+    interval = int(getenv('SCHEDULER_INTERVAL', 600))
+    worker = '{}:{}'.format(socket.gethostname(), getpid())
+    # Loop to queue and deliver vaccination reminder emails, compact the
+    # vaccine stock movements and refresh the dashboard statistics, waiting
+    # for the next due boundary between runs. Several schedulers can run at
+    # once, each on its own partitions.
+    try:
+        while True:
+            send_emails(claim_shards(worker), worker)
+            deliver_emails(worker=worker)
+            compact_stock()
+            refresh_dashboard()
+            wait = next_run(interval)
+            while wait > 0:
+                time.sleep(min(wait, HEARTBEAT_SECONDS))
+                wait -= HEARTBEAT_SECONDS
+                claim_shards(worker)
+                storage.close()
+    finally:
+        storage.release_leases('reminders', worker)
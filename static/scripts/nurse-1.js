@@ -116,12 +116,17 @@ function childVaccination(hospitalId) {
                 document.getElementById("error_message-2").innerHTML = errorMarkOpenTag + ' The child has already been vaccinated with this dose</mark>';
             } else {
                 document.getElementById("error_message-2").innerHTML = successMarkOpenTag + ' The child\'s vaccination registration was successful</mark>';
+                // The projections no longer count the vaccinated child
+                vaccinationsByRange = {};
             }
         })
     }
 }
 
 
+// Projected vaccinations of all the doses, keyed by range
+let vaccinationsByRange = {};
+
 // Function to project future vaccinations based on selected vaccine and time range
 function vaccinationTracker() {
     clearErrorMessage();
@@ -131,14 +136,20 @@ function vaccinationTracker() {
         document.getElementById("error_message-3").innerHTML = errorMarkOpenTag + ' Please select a vaccine and range</mark>';
     } else {
         document.getElementById("error_message-3").innerHTML = '&nbsp;';
-        fetch('/dose/' + id + '/range/' + range, {
-            method: "GET",
-        }).then((response) => {
-            if (!response.ok) {
-                throw new Error();
-            }
-            return response.json();
-        }).then(data => {
+        // A single request projects all the doses, the other doses are then served from it
+        if (!(range in vaccinationsByRange)) {
+            vaccinationsByRange[range] = fetch('/doses/range/' + range, {
+                method: "GET",
+            }).then((response) => {
+                if (!response.ok) {
+                    delete vaccinationsByRange[range];
+                    throw new Error();
+                }
+                return response.json();
+            });
+        }
+        vaccinationsByRange[range].then(doses => {
+            const data = doses[id];
             document.getElementById("succes_message-1").innerHTML = 'In ' + range + ' days ' + data.vaccination + ' children will be vaccinated with ' + data.dose;
             $('#vaccination_tracker').modal('show');
         })
@@ -27,18 +27,58 @@ def load_user(user_id):
     Loads the current user from the database.
 
     Args:
-    - user_id: ID of the user
+    - user_id: ID of the user, tagged with its role ('user:<id>' or
+      'nurse:<id>') so only the matching table is queried. Untagged IDs from
+      sessions opened before the tag was introduced are looked up in both tables.
 
     Returns:
     - User or Nurse object based on the user ID
 
     """
+    role, _, user_id = user_id.rpartition(':')
+    if role == 'nurse':
+        return storage.get_by_id(Nurse, user_id)
     user = storage.get_by_id(User, user_id)
-    if not user:
+    if not user and role != 'user':
         user = storage.get_by_id(Nurse, user_id)
     return user
 
 
+@app.before_request
+def begin_unit_of_work():
+    """
+    Starts the unit of work of the request.
+
+    Changes saved by the views are flushed to the database as they happen and
+    committed once, when the response is ready.
+
+    """
+    storage.begin()
+
+
+@app.after_request
+def commit_unit_of_work(response):
+    """
+    Commits the unit of work of the request.
+
+    Flask still runs this handler when a view raised and the error was turned into
+    a 500 response, so the unit of work is rolled back on any server error instead
+    of committing the changes the view flushed before failing.
+
+    Args:
+    - response: The response returned by the view
+
+    Returns:
+    - The unchanged response
+
+    """
+    if response.status_code >= 500:
+        storage.rollback()
+    else:
+        storage.commit()
+    return response
+
+
 @app.teardown_appcontext
 def teardown(_):
     """
@@ -46,7 +86,7 @@ def teardown(_):
 
     This function is registered with Flask's app context teardown. It ensures the SQLAlchemy session
     is closed at the end of each request, preventing potential resource leaks and managing the
-    lifecycle of the database connection.
+    lifecycle of the database connection. Changes not committed by the unit of work are discarded.
 
     """
     storage.close()
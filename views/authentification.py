@@ -9,6 +9,7 @@ from flask_login import current_user, login_required, login_user, logout_user
 import json
 from models import storage
 from models.tables import *
+from modules.email_templates import render
 from modules.send_email import send_email
 import os
 import uuid
@@ -205,9 +206,9 @@ def verify_email(user):
     """
     Sends an email with a verification link to the user or nurse.
 
-    Generates a verification token, saves it to the provided user or nurse's data, and constructs an email
-    with a verification link that directs them to verify their email address. The email is sent to the
-    respective user or nurse's email address.
+    Generates a verification token, saves it to the provided user or nurse's data, and renders the
+    'verification.html' email template with a verification link that directs them to verify their email
+    address. The email is sent to the respective user or nurse's email address.
 
     Arguments:
     - user: An instance of the User or Nurse model representing the individual to whom the verification
@@ -219,18 +220,6 @@ def verify_email(user):
     user.token = token
     storage.save()
     verification_link = url_for('app_views.verify_email_token', receiver_email=user.email, receiver_token=token, _external=True)
-    subject = 'VaxWise APP Email Verification'
-    html_content=f"""
-    <html>
-        <body style="text-align:center">
-            <br />
-            <h1>VaxWise APP</h1>
-            <strong style="font-size:18px; display: block;">Welcome to our platform!</strong>
-            <p style="font-size:16px;">To get started, please verify your email address by clicking the link below:</p>
-            <a href="{verification_link}"  style="font-size:16px; display: block;">Verify Email</a>
-            <p  style="font-size:16px;">If you did not sign up for our platform, please ignore this email.</p><br />
-            <p style="font-size:16px;">Thank you!</p>
-        </body>
-    </html>
-    """
+    subject, html_content = render('verification.html',
+                                   verification_link=verification_link)
     send_email(subject, html_content, user.email)
@@ -10,7 +10,7 @@ from flask_login import current_user, login_required
 import json
 from models import storage
 from models.tables import *
-from modules.redirect_user import redirect_user
+from modules.redirect_user import role_required
 import uuid
 from views import app_views
 
@@ -41,6 +41,7 @@ def get_child(id):
 
 @app_views.route('/child/<id>', methods=['DELETE'])
 @login_required
+@role_required('User')
 def delete_child(id):
     """
     Deletes a child's information by ID.
@@ -58,8 +59,6 @@ def delete_child(id):
     - An empty JSON response indicating the completion of the deletion process.
 
     """
-    if redirect_user('User'):
-        return redirect_user('User')
     child = storage.get_by_id(Child, id)
     if child:
         storage.delete(child)
@@ -69,6 +68,7 @@ def delete_child(id):
 
 @app_views.route('/child', methods=['POST'])
 @login_required
+@role_required('User')
 def add_child():
     """
     Adds a new child to the system.
@@ -76,15 +76,14 @@ def add_child():
     Adds a new child to the system based on the provided data in the request. First, it ensures
     the user is redirected if they are not of type 'User'. Then, it extracts the necessary data
     from the request payload (first name, last name, birthday, and parent ID) and creates a new
-    Child instance. This new child is then added to the storage and saved. The function returns
-    an empty JSON response indicating the completion of the addition process.
+    Child instance. The due dates of its doses are scheduled, then the new child is added to the
+    storage and saved. The function returns an empty JSON response indicating the completion of
+    the addition process.
 
     Returns:
     - An empty JSON response indicating the completion of the addition of a new child.
 
     """
-    if redirect_user('User'):
-        return redirect_user('User')
     data = json.loads(request.data)
     kwargs = {
         'id': str(uuid.uuid4()),
@@ -94,6 +93,7 @@ def add_child():
         'parent_id': current_user.id
     }
     new_child = Child(**kwargs)
+    storage.schedule_child(new_child)
     storage.new(new_child)
     storage.save()
     return jsonify({})
@@ -101,6 +101,7 @@ def add_child():
 
 @app_views.route('/child', methods=['PUT'])
 @login_required
+@role_required('User')
 def update_child():
     """
     Updates a child's information.
@@ -108,16 +109,14 @@ def update_child():
     Updates the information of an existing child in the system based on the provided data in the request.
     The function first ensures the user is redirected if they are not of type 'User'. Then, it extracts the
     necessary data from the request payload (child ID, first name, and birthday) and attempts to retrieve
-    the corresponding child from the storage. If the child exists, it updates the specified attributes and
-    saves the changes to the storage. The function returns an empty JSON response indicating the completion
-    of the update process.
+    the corresponding child from the storage. If the child exists, it updates the specified attributes,
+    refreshes the due dates of its doses and saves the changes to the storage. The function returns an
+    empty JSON response indicating the completion of the update process.
 
     Returns:
     - An empty JSON response indicating the completion of the update of a child's information.
 
     """
-    if redirect_user('User'):
-        return redirect_user('User')
     data = json.loads(request.data)
     kwargs = {
         'first_name': data['first_name'],
@@ -127,5 +126,6 @@ def update_child():
     if child:
         for key, value in kwargs.items():
             setattr(child, key, value)
+        storage.schedule_child(child)
         storage.save()
     return jsonify({})
@@ -6,13 +6,14 @@ from flask import jsonify
 from flask_login import login_required
 from models import storage
 from models.tables import *
-from modules.redirect_user import redirect_user
+from modules.redirect_user import role_required
 from views import app_views
 
 
 @app_views.route('/hospital/<hospital_id>/child/<child_id>/dose/<dose_id>',
                  methods=['GET'])
 @login_required
+@role_required('Nurse')
 def child_vaccination(hospital_id, child_id, dose_id):
     """
     Manages child vaccination record.
@@ -20,8 +21,9 @@ def child_vaccination(hospital_id, child_id, dose_id):
     Manages the vaccination record for a child in a hospital for a specific dose. The function ensures
     the user is redirected if they are of type 'Nurse'. It retrieves information about the child,
     dose, and vaccine based on the provided IDs. It checks if the child has already received the dose;
-    if not, it adds the dose to the child's vaccination record and updates the vaccine stock accordingly.
-    It also updates the quantity of the specific vaccine in the hospital's inventory if it exists.
+    if not, it adds the dose to the child's vaccination record, marks it as done in the child's schedule
+    and appends a stock movement decrementing the vaccine stock and the quantity of the specific vaccine
+    in the hospital's inventory.
 
     Arguments:
     - hospital_id: The ID of the hospital where the vaccination is being recorded.
@@ -34,21 +36,17 @@ def child_vaccination(hospital_id, child_id, dose_id):
       vaccine and hospital inventory quantities.
 
     """
-    if redirect_user('Nurse'):
-        return redirect_user('Nurse')
     child = storage.get_by_id(Child, child_id)
     dose = storage.get_by_id(Dose, dose_id)
     if child and dose:
-        vaccine = storage.get_by_id(Vaccine, dose.vaccine_id)
         if dose in child.doses:
             return jsonify({'status': 'Exist'})
-        else:
-            child.doses.append(dose)
-            vaccine.stock -= 1
-            storage.save()
-    hospital_vaccines = storage.all(Hospital_Vaccine).values()
-    for item in hospital_vaccines:
-        if item.hospital_id == hospital_id and item.vaccine_id == vaccine.id:
-            item.quantity -= 1
-            storage.save()
+        child.doses.append(dose)
+        for scheduled in child.schedule:
+            if scheduled.dose_id == dose.id:
+                scheduled.status = 'done'
+        storage.new(Stock_Movement(hospital_id=hospital_id,
+                                   vaccine_id=dose.vaccine_id, delta=-1,
+                                   reason='vaccination'))
+        storage.save()
     return jsonify({})
@@ -9,22 +9,23 @@ from flask_login import current_user, login_required
 import json
 from models import storage
 from models.tables import *
-from modules.redirect_user import redirect_user
+from modules.redirect_user import role_required
+from sqlalchemy import func
 import uuid
 from views import app_views
 
 
 @app_views.route('/hospital/<name>', methods=['GET'])
 @login_required
+@role_required('Admin')
 def get_hospital(name):
     """
     Retrieves a hospital by name.
 
     Retrieves and checks if a hospital exists in the system based on the provided name.
-    The function ensures the user is redirected if they are not of type 'Admin'. It fetches
-    all hospitals from the storage and extracts their names to create a list of lowercase
-    hospital names. It then checks if the provided name (converted to lowercase) exists
-    within this list of hospital names. If found, it returns a JSON response with status
+    The function ensures the user is redirected if they are not of type 'Admin'. It counts
+    the hospitals whose lowercase name matches the provided name (converted to lowercase)
+    directly in the database. If found, it returns a JSON response with status
     'Exist'; otherwise, it returns a JSON response with status 'Not Exist'.
 
     Arguments:
@@ -35,41 +36,39 @@ def get_hospital(name):
     - JSON response: {'status': 'Not Exist'} if the hospital does not exist.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
-    hospitals = storage.all(Hospital).values()
-    hospital_names = [hospital.name.lower() for hospital in hospitals]
-    if name.lower() in hospital_names:
+    if storage.count(Hospital, func.lower(Hospital.name) == name.lower()):
         return jsonify({ 'status': 'Exist'})
     return jsonify({ 'status': 'Not Exist'})
 
 
 @app_views.route('/hospitals', methods=['GET'])
 @login_required
+@role_required('Admin')
 def get_hospitals():
     """
     Renders a list of hospitals.
 
     Renders the 'admin-2.html' template displaying a list of hospitals available in the system.
     The function ensures the user is redirected if they are not of type 'Admin'. It retrieves all
-    hospitals from the storage, sorts them alphabetically by name, and sends the sorted list to
-    the 'admin-2.html' template for rendering.
+    hospitals sorted alphabetically by name from the reference data cache, counts their nurses with
+    a single grouped query, and sends them to the 'admin-2.html' template for rendering.
 
     Returns:
-    - Renders the 'admin-2.html' template with the sorted list of hospitals and the current user's
-      information for display.
+    - Renders the 'admin-2.html' template with the sorted list of hospitals, their nurse counts and
+      the current user's information for display.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
-    hospitals = storage.all(Hospital).values()
-    sorted_hospitals = sorted(hospitals, key=lambda hospital: hospital.name)
+    sorted_hospitals = storage.reference(Hospital).rows
+    nurses_count = dict(storage.query(Nurse, columns=[Nurse.hospital_id,
+                                                      func.count()],
+                                      group_by=Nurse.hospital_id))
     return render_template("admin-2.html", hospitals=sorted_hospitals,
-                           user=current_user)
+                           nurses_count=nurses_count, user=current_user)
 
 
 @app_views.route('/hospital', methods=['POST'])
 @login_required
+@role_required('Admin')
 def add_hospital():
     """
     Adds a new hospital to the system.
@@ -85,8 +84,6 @@ def add_hospital():
     - An empty JSON response indicating the completion of adding a new hospital.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
     data = json.loads(request.data)
     kwargs = {
         'id': str(uuid.uuid4()),
@@ -94,45 +91,43 @@ def add_hospital():
     }
     hospital = Hospital(**kwargs)
     storage.new(hospital)
-    storage.save()
-    vaccines = storage.all(Vaccine).values()
+    vaccines = storage.reference(Vaccine).rows
     for vaccine in vaccines:
         new_hospital_vaccine = Hospital_Vaccine(id=str(uuid.uuid4()),
                                                 hospital_id=hospital.id,
                                                 vaccine_id=vaccine.id)
         storage.new(new_hospital_vaccine)
-        storage.save()
+    storage.save()
     return jsonify({})
 
 
 @app_views.route('/hospital/nurses', methods=['POST'])
 @login_required
+@role_required('Admin')
 def hospital_nurses():
     """
     Retrieves nurses associated with a hospital.
 
     Retrieves and returns a list of nurses associated with a specific hospital based on the provided
     hospital ID in the request. The function ensures the user is redirected if they are not of type 'Admin'.
-    It fetches all nurses from the storage and creates a list containing details of nurses linked to
-    the given hospital ID. This list is then returned in JSON format.
+    It fetches the details of the nurses linked to the given hospital ID from the storage, without their
+    credentials, and creates a list containing them. This list is then returned in JSON format.
 
     Returns:
     - JSON response: A list of nurse details associated with the specified hospital ID.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
     data = json.loads(request.data)
-    nurses = storage.all(Nurse).values()
-    nurses_list = []
-    for nurse in nurses:
-        if nurse.hospital_id == data['id']:
-            nurses_list.append(nurse.to_dict())
+    nurses = storage.query(Nurse, hospital_id=data['id'],
+                           columns=['id', 'first_name', 'last_name', 'email',
+                                    'hospital_id'])
+    nurses_list = [nurse._asdict() for nurse in nurses]
     return jsonify(nurses_list)
 
 
 @app_views.route('/hospital/vaccines', methods=['POST'])
 @login_required
+@role_required('Admin')
 def hospital_vaccines():
     """
     Retrieves vaccines available in a hospital.
@@ -147,21 +142,23 @@ def hospital_vaccines():
     - JSON response: A list of vaccine details and quantities available at the specified hospital ID.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
     data = json.loads(request.data)
-    hospital_vaccines = storage.all(Hospital_Vaccine).values()
+    hospital_vaccines = storage.query(Hospital_Vaccine,
+                                      hospital_id=data['id'])
+    vaccines = storage.reference(Vaccine).by_id
+    stock = storage.get_stock(data['id'])
     vaccines_list = []
     for hospital in hospital_vaccines:
-        if hospital.hospital_id == data['id']:
-            vaccine = storage.get_by_id(Vaccine, hospital.vaccine_id)
-            vaccines_list.append({'denomination': vaccine.denomination,
-                                  'quantity': hospital.quantity})
+        vaccine = vaccines[hospital.vaccine_id]
+        vaccines_list.append({'denomination': vaccine.denomination,
+                              'quantity': stock.get(hospital.vaccine_id,
+                                                    hospital.quantity)})
     return jsonify(vaccines_list)
 
 
 @app_views.route('/hospital/add-vaccine', methods=['POST'])
 @login_required
+@role_required('Nurse')
 def hospital_add_vaccine():
     """
     Adds a vaccine to a hospital's inventory.
@@ -170,21 +167,22 @@ def hospital_add_vaccine():
     The function ensures that only users who are of type 'Nurse' can access this functionality.
     It retrieves the hospital and vaccine using the provided IDs from the request data. If the vaccine
     already exists in the hospital's inventory, it returns a JSON response indicating its existence.
-    Otherwise, it appends the vaccine to the hospital's vaccines list, updates the vaccine's stock,
-    saves the changes, and returns an empty JSON response upon successful addition.
+    Otherwise, it adds the vaccine to the hospital's inventory, appends a stock movement with the
+    provided stock, saves the changes, and returns an empty JSON response upon successful addition.
 
     Returns:
     - An empty JSON response upon successfully adding the vaccine to the hospital's inventory.
 
     """
-    if redirect_user('Nurse'):
-        return redirect_user('Nurse')
     data = json.loads(request.data)
-    hospital = storage.get_by_id(Hospital, data.get('hospital_id'))
-    vaccine = storage.get_by_id(Vaccine, data.get('vaccine_id'))
-    if vaccine in hospital.vaccines:
+    hospital_id = data.get('hospital_id')
+    vaccine_id = data.get('vaccine_id')
+    if storage.count(Hospital_Vaccine, hospital_id=hospital_id,
+                     vaccine_id=vaccine_id):
         return jsonify({ 'status': 'Exist'})
-    hospital.vaccines.append(vaccine)
-    vaccine.stock += int(data.get('stock'))
+    storage.new(Hospital_Vaccine(id=str(uuid.uuid4()), hospital_id=hospital_id,
+                                 vaccine_id=vaccine_id, quantity=0))
+    storage.new(Stock_Movement(hospital_id=hospital_id, vaccine_id=vaccine_id,
+                               delta=int(data.get('stock')), reason='restock'))
     storage.save()
     return jsonify({})
@@ -9,12 +9,16 @@ from flask_login import current_user, login_required, logout_user
 import json
 from models import storage
 from models.tables import *
-from modules.redirect_user import redirect_user
+from modules.email_templates import render
+from modules.redirect_user import role_required
 from modules.send_email import send_email
 import uuid
 from views import app_views
 from werkzeug.security import generate_password_hash
 
+# Columns of the nurses listed to administrators
+NURSE_COLUMNS = ['id', 'first_name', 'last_name', 'hospital_id']
+
 
 @app_views.route('/nurse/<id>', methods=['GET'])
 @login_required
@@ -37,7 +41,7 @@ def get_nurse(id):
     """
     nurse = storage.get_by_id(Nurse, id)
     if nurse:
-        hospital = storage.get_by_id(Hospital, nurse.hospital_id)
+        hospital = storage.reference(Hospital).get(nurse.hospital_id)
         return jsonify({'email': nurse.email,
                         'first_name': nurse.first_name,
                         'last_name': nurse.last_name,
@@ -47,13 +51,14 @@ def get_nurse(id):
 
 @app_views.route('/nurses', methods=['GET'])
 @login_required
+@role_required('Admin')
 def get_nurses():
     """
     Renders the list of nurses for administrators.
 
     Renders the 'admin-3.html' template, displaying a list of nurses in the system. The function ensures
     the user is redirected if they are not of type 'Admin'. It fetches information about all hospitals and
-    nurses from storage and sorts the nurses alphabetically by their first names. The sorted list of nurses
+    the listed columns of the nurses from storage, sorted alphabetically by their first names. The sorted list of nurses
     along with hospitals and user data is sent to the 'admin-3.html' template for display.
 
     Returns:
@@ -61,11 +66,9 @@ def get_nurses():
       display to administrators.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
-    hospitals = storage.all(Hospital).values()
-    nurses = storage.all(Nurse).values()
-    sorted_nurses = sorted(nurses, key=lambda nurse: nurse.first_name)
+    hospitals = storage.reference(Hospital).rows
+    sorted_nurses = storage.query(Nurse, order_by=Nurse.first_name,
+                                  columns=NURSE_COLUMNS)
     return render_template("admin-3.html", nurses=sorted_nurses,
                            hospitals=hospitals,
                            user=current_user)
@@ -73,6 +76,7 @@ def get_nurses():
 
 @app_views.route('/nurse', methods=['POST'])
 @login_required
+@role_required('Admin')
 def add_nurse():
     """
     Adds a new nurse to the system by an Admin.
@@ -89,8 +93,6 @@ def add_nurse():
     for display to administrators after successfully adding the new nurse.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
     data = json.loads(request.data)
     password = data['password']
     data['id'] = str(uuid.uuid4())
@@ -101,14 +103,15 @@ def add_nurse():
     storage.new(new_nurse)
     storage.save()
     contact_nurse(new_nurse, password, False)
-    hospitals = storage.all(Hospital).values()
-    nurses = storage.all(Nurse).values()
+    hospitals = storage.reference(Hospital).rows
+    nurses = storage.query(Nurse, columns=NURSE_COLUMNS)
     return render_template("admin-3.html", nurses=nurses, hospitals=hospitals,
                            user=current_user)
 
 
 @app_views.route('/nurse', methods=['DELETE'])
 @login_required
+@role_required('Admin')
 def delete_nurse():
     """
     Deletes a nurse from the system by an Admin.
@@ -121,8 +124,6 @@ def delete_nurse():
     - An empty JSON response after deleting the nurse (if found).
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
     data = json.loads(request.data)
     nurse = storage.get_by_id(Nurse, data['id'])
     if nurse:
@@ -133,6 +134,7 @@ def delete_nurse():
 
 @app_views.route('/nurse', methods=['PUT'])
 @login_required
+@role_required('Admin', 'Nurse')
 def update_nurse():
     """
     Updates nurse information in the system.
@@ -151,8 +153,6 @@ def update_nurse():
       for display to administrators after successfully updating nurse information.
 
     """
-    if redirect_user('Admin') and redirect_user('Nurse'):
-        return redirect_user('Admin')
     data = json.loads(request.data)
     nurse = storage.get_by_id(Nurse, data.get('id'))
     password = data['password']
@@ -178,14 +178,15 @@ def update_nurse():
         contact_nurse(nurse, password, True)
     else:
         contact_nurse(nurse, password, False)
-    hospitals = storage.all(Hospital).values()
-    nurses = storage.all(Nurse).values()
+    hospitals = storage.reference(Hospital).rows
+    nurses = storage.query(Nurse, columns=NURSE_COLUMNS)
     return render_template("admin-3.html", nurses=nurses, hospitals=hospitals,
                            user=current_user)
 
 
 @app_views.route('/nurse/hospital', methods=['PUT'])
 @login_required
+@role_required('Admin')
 def nurse_hospital():
     """
     Updates the hospital assigned to a nurse.
@@ -201,15 +202,13 @@ def nurse_hospital():
       for display to administrators after successfully updating the nurse's hospital assignment.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
     data = json.loads(request.data)
     nurse = storage.get_by_id(Nurse, data.get('id'))
     if nurse: 
         setattr(nurse, 'hospital_id', data.get('hospital_id'))
         storage.save()
-    hospitals = storage.all(Hospital).values()
-    nurses = storage.all(Nurse).values()
+    hospitals = storage.reference(Hospital).rows
+    nurses = storage.query(Nurse, columns=NURSE_COLUMNS)
     return render_template("admin-3.html", nurses=nurses, hospitals=hospitals,
                            user=current_user)
 
@@ -218,10 +217,11 @@ def contact_nurse(nurse, password, verified):
     """
     Sends account details to a nurse's email.
 
-    Generates and assigns a unique token to the nurse, which is then used to create an email containing
-    login credentials for the nurse. The email is sent either for account verification (if 'verified' is True)
-    or for informing about an account created/update. It includes the nurse's login credentials and provides
-    a link for email verification or login. The email is sent to the nurse's provided email address.
+    Generates and assigns a unique token to the nurse, which is then used to render the
+    'nurse-credentials.html' email template containing login credentials for the nurse. The email is sent
+    either for account verification (if 'verified' is True) or for informing about an account
+    created/update. It includes the nurse's login credentials and provides a link for email verification
+    or login. The email is sent to the nurse's provided email address.
 
     Args:
     - nurse: Nurse object containing nurse information.
@@ -235,40 +235,12 @@ def contact_nurse(nurse, password, verified):
     token = secrets.token_urlsafe(16)
     nurse.token = token
     storage.save()
-    subject = 'Your Account Credentials for VaxWise App'
-    html_content = ''
     if verified:
-        verification_link = url_for('app_views.login', _external=True)
-        html_content = f"""
-        <html>
-            <body>
-                <h1>VaxWise APP</h1>
-                <p style="font-size:16px;"><b>Dear {nurse.first_name},</b></p>
-                <p style="font-size:16px;">We are delighted to inform you that an account has been updated for you on VaxWise. Below are your login credentials:</p>
-                <p style="font-size:16px;">Email Address: <b>{nurse.email}</b></p>
-                <p style="font-size:16px;">Password: <b>{password}</b><br></p>
-                <p style="font-size:16px;">For security reasons, we recommend changing your password after your initial login. Please ensure that you keep your login credentials confidential and do not share them with anyone.</p>
-                <p style="font-size:16px;">To access your account, follow this link <a href="{verification_link}" style="font-size:16px;">here</a> .<br></p>
-                <p style="font-size:16px;">Best regards,</p>
-                <p style="font-size:16px;"><b>VaxWise Team</b></p>
-            </body>
-        </html>
-        """        
+        link = url_for('app_views.login', _external=True)
     else:
-        verification_link = url_for('app_views.verify_email_token', receiver_email=nurse.email, receiver_token=token, _external=True)
-        html_content = f"""
-        <html>
-            <body>
-                <h1>VaxWise APP</h1>
-                <p style="font-size:16px;"><b>Dear {nurse.first_name},</b></p>
-                <p style="font-size:16px;">We are delighted to inform you that an account has been created/updated for you on VaxWise. Below are your login credentials:</p>
-                <p style="font-size:16px;">Email Address: <b>{nurse.email}</b></p>
-                <p style="font-size:16px;">Password: <b>{password}</b><br></p>
-                <p style="font-size:16px;">For security reasons, we recommend changing your password after your initial login. Please ensure that you keep your login credentials confidential and do not share them with anyone.</p>
-                <p style="font-size:16px;">To access your account, follow this link <a href="{verification_link}" style="font-size:16px;">Verify Email</a> to verify your email address.<br></p>
-                <p style="font-size:16px;">Best regards,</p>
-                <p style="font-size:16px;"><b>VaxWise Team</b></p>
-            </body>
-        </html>
-        """
+        link = url_for('app_views.verify_email_token', receiver_email=nurse.email, receiver_token=token, _external=True)
+    subject, html_content = render('nurse-credentials.html',
+                                   first_name=nurse.first_name,
+                                   email=nurse.email, password=password,
+                                   verified=verified, link=link)
     send_email(subject, html_content, nurse.email)
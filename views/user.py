@@ -9,7 +9,7 @@ from flask_login import current_user, login_required, logout_user
 import json
 from models import storage
 from models.tables import *
-from modules.redirect_user import redirect_user
+from modules.redirect_user import role_required
 from views import app_views
 from werkzeug.security import generate_password_hash
 
@@ -42,6 +42,7 @@ def get_user(email):
 
 @app_views.route('/user', methods=['PUT'])
 @login_required
+@role_required('User')
 def update_user():
     """
     Updates user information.
@@ -61,8 +62,6 @@ def update_user():
 
     """
     from views.authentification import verify_email
-    if redirect_user('User'):
-        return redirect_user('User')
     data = json.loads(request.data)
     user = storage.get_by_id(User, current_user.id)
     data['password'] = generate_password_hash(data['password'],
@@ -81,24 +80,26 @@ def update_user():
 
 @app_views.route('/user/children', methods=['POST'])
 @login_required
+@role_required('Nurse')
 def parent_children():
     """
     Retrieves children associated with a parent user.
 
     Retrieves children associated with a parent user based on the provided email in the request data.
     The function ensures that only users who are of type 'Nurse' can access this functionality.
-    It fetches the user using the given email and retrieves information about their children, returning
+    It fetches the user using the given email and retrieves their children with a single query, returning
     a JSON response containing the children's details if the user is found.
 
     Returns:
     - A JSON response containing the details of children associated with the parent user (if found).
 
     """
-    if redirect_user('Nurse'):
-        return redirect_user('Nurse')
     data = json.loads(request.data)
     user = storage.get_by_email(User, data.get('email'))
     if user:
-        children = [child.to_dict() for child in user.children]
+        children = storage.query(Child, parent_id=user.id,
+                                 columns=['id', 'first_name', 'last_name',
+                                          'birthdate', 'parent_id'])
+        children = [child._asdict() for child in children]
         return jsonify(children)
-    return jsonify({})
\ No newline at end of file
+    return jsonify({})
@@ -1,17 +1,18 @@
 #!/usr/bin/python3
 """
 This module handles views and routes for the Flask application, including get_vaccine,
-implement_stock, vaccination_tracker, admin_vaccines_table, nurse_vaccines_table,
+implement_stock, vaccination_tracker, vaccinations_tracker, admin_vaccines_table, nurse_vaccines_table,
 index_vaccines_table and rendering templates for the application's user interface.
 
 """
-from datetime import datetime
+from datetime import date, timedelta
 from flask import jsonify, render_template, request
 from flask_login import current_user, login_required
 from models.tables import *
 from models import storage
-from modules.redirect_user import redirect_user
+from modules.redirect_user import role_required
 import os
+from sqlalchemy import func
 from views import app_views
 
 
@@ -37,16 +38,15 @@ def get_vaccine(id):
     """
     vaccine = storage.get_by_id(Vaccine, id)
     if vaccine:
-        user = storage.get_by_id(User, current_user.id)
-        if user and user.email != os.getenv('ADMIN_USERNAME'):
-            dose_list = []
-            doses = storage.all(Dose).values()
-            sorted_doses = sorted(doses, key=lambda dose: dose.denomination)            
-            for dose in sorted_doses:
-                if dose.vaccine_id == vaccine.id:
-                    dose_list.append([dose.denomination, dose.term])
+        if isinstance(current_user, User) and \
+                current_user.email != os.getenv('ADMIN_USERNAME'):
+            doses = storage.reference(Dose).by_vaccine_id.get(vaccine.id, ())
+            dose_list = [[dose.denomination, dose.term] for dose in doses]
             return jsonify({'denomination': vaccine.denomination, 'description': vaccine.description, 'doses': dose_list})
-        return jsonify(vaccine.to_dict())
+        vaccine_dict = vaccine.to_dict()
+        vaccine_dict['stock'] = storage.get_stock(vaccine_id=vaccine.id).get(
+            vaccine.id, vaccine.stock)
+        return jsonify(vaccine_dict)
     return jsonify({})
 
 
@@ -91,14 +91,16 @@ def get_vaccine(id):
 
 @app_views.route('/dose/<id>/range/<range>', methods=['GET'])
 @login_required
+@role_required('Nurse')
 def vaccination_tracker(id, range):
     """
     Projects future vaccinations for a specific dose within a provided time period.
 
     Retrieves information to project the future vaccinations for a specific dose based on the provided dose ID
     and the time period in days. The function ensures that only users who are of type 'Nurse' can access this functionality.
-    The function calculates the potential number of children eligible for the specified dose within the provided time period,
-    indicating the projected vaccinations needed.
+    The function counts, with a range scan on the (dose, status, due date) index of the schedule of the children,
+    those not yet vaccinated whose due date for the specified dose falls within the provided time period, indicating
+    the projected vaccinations needed.
 
     Arguments:
     - id: The ID of the dose to project future vaccinations for.
@@ -109,30 +111,75 @@ def vaccination_tracker(id, range):
       for the provided time period.
 
     """
-    if redirect_user('Nurse'):
-        return redirect_user('Nurse')
-    dose = storage.get_by_id(Dose, id)
-    children = storage.all(Child).values()
-    vaccination = 0
-    for child in children:
-        age_in_days = (datetime.now() - child.birthdate).days + 1
-        if age_in_days + int(range) >= dose.term:
-            vaccination += 1
+    dose = storage.reference(Dose).get(id)
+    until = date.today() + timedelta(days=int(range))
+    vaccination = storage.count(Child_Dose_Schedule,
+                                Child_Dose_Schedule.due_date <= until,
+                                Child_Dose_Schedule.status.in_(
+                                    ('pending', 'notified')),
+                                dose_id=id)
     return jsonify({ 'dose': dose.denomination, 'vaccination': vaccination})
 
 
+@app_views.route('/doses/range/<range>', methods=['GET'])
+@app_views.route('/hospital/<hospital_id>/doses/range/<range>', methods=['GET'])
+@login_required
+@role_required('Nurse')
+def vaccinations_tracker(range, hospital_id=None):
+    """
+    Projects future vaccinations for all the doses within a provided time period.
+
+    Retrieves information to project the future vaccinations of every dose at once, so the client
+    does not need one request per dose. The function ensures that only users who are of type 'Nurse'
+    can access this functionality. The children not yet vaccinated whose due date falls within the
+    provided time period are counted per dose with a single grouped range scan on the (dose, status,
+    due date) index of the schedule of the children. When a hospital is given, only the doses of the
+    vaccines it stocks are projected.
+
+    Arguments:
+    - range: The time period (in days) within which future vaccinations are projected.
+    - hospital_id: The optional ID of the hospital to restrict the doses to.
+
+    Returns:
+    - JSON response mapping the ID of each dose to its denomination and the projected number of
+      vaccinations required for the provided time period.
+
+    """
+    doses = storage.reference(Dose)
+    if hospital_id is None:
+        dose_ids = [dose.id for dose in doses.rows]
+    else:
+        vaccine_ids = storage.query(Hospital_Vaccine, columns=['vaccine_id'],
+                                    hospital_id=hospital_id)
+        dose_ids = [dose.id for row in vaccine_ids
+                    for dose in doses.by_vaccine_id.get(row.vaccine_id, ())]
+    until = date.today() + timedelta(days=int(range))
+    counts = dict(storage.query(Child_Dose_Schedule,
+                                Child_Dose_Schedule.due_date <= until,
+                                Child_Dose_Schedule.status.in_(
+                                    ('pending', 'notified')),
+                                Child_Dose_Schedule.dose_id.in_(dose_ids),
+                                columns=[Child_Dose_Schedule.dose_id,
+                                         func.count()],
+                                group_by=Child_Dose_Schedule.dose_id))
+    return jsonify({id: {'dose': doses.get(id).denomination,
+                         'vaccination': counts.get(id, 0)}
+                    for id in dose_ids})
+
+
 @app_views.route('/hospital/<hospital_id>/vaccine/<vaccine_id>/<quantity>',
                  methods=['PUT'])
 @login_required
+@role_required('Nurse')
 def implement_stock(hospital_id, vaccine_id, quantity):
     """
     Updates vaccine stock for a hospital.
 
     Modifies the stock quantity of a particular vaccine available at a specified hospital.
     The function ensures that only users who are of type 'Nurse' can access this functionality.
-    The function retrieves existing hospital-vaccine relationships and increases the stock
-    quantity of a specific vaccine in the specified hospital by the provided quantity.
-    After updating the stock quantity, the changes are saved to the storage.
+    The function appends a stock movement increasing the stock quantity of a specific vaccine
+    in the specified hospital and the overall vaccine stock by the provided quantity.
+    The movement is rolled up into the stock counters by the periodic compaction.
 
     Arguments:
     - hospital_id: The ID of the hospital where the vaccine stock is updated.
@@ -143,23 +190,15 @@ def implement_stock(hospital_id, vaccine_id, quantity):
     - Empty JSON response to indicate the successful update of the vaccine stock.
 
     """
-    if redirect_user('Nurse'):
-        return redirect_user('Nurse')
-    hospital_vaccines = storage.all(Hospital_Vaccine).values()
-    for vaccine in hospital_vaccines:
-        if vaccine.hospital_id == hospital_id and vaccine.vaccine_id == vaccine_id:
-            vaccine.quantity += int(quantity)
-            break
+    storage.new(Stock_Movement(hospital_id=hospital_id, vaccine_id=vaccine_id,
+                               delta=int(quantity), reason='restock'))
     storage.save()
-    vaccine = storage.get_by_id(Vaccine, vaccine_id)
-    if vaccine:
-        vaccine.stock += int(quantity)
-        storage.save()
     return jsonify({})
 
 
 @app_views.route('/vaccines', methods=['GET'])
 @login_required
+@role_required('Admin')
 def admin_vaccines_table():
     """
     Renders the vaccines table.
@@ -172,8 +211,6 @@ def admin_vaccines_table():
     - Renders the 'admin-4.html' template displaying the vaccines table and navigation controls.
 
     """
-    if redirect_user('Admin'):
-        return redirect_user('Admin')
     referring_url = request.referrer
     return render_template("admin-4.html", back_url=referring_url,
                            user=current_user)
@@ -181,6 +218,7 @@ def admin_vaccines_table():
 
 @app_views.route('/nurse/vaccines-table', methods=['GET'])
 @login_required
+@role_required('Nurse')
 def nurse_vaccines_table():
     """
     Renders a static vaccination schedule page for nurses.
@@ -192,8 +230,6 @@ def nurse_vaccines_table():
     - Renders the 'nurse-2.html' template, which contains the static vaccination schedule.
 
     """
-    if redirect_user('Nurse'):
-        return redirect_user('Nurse')
     return render_template("nurse-2.html", user=current_user)
 
 